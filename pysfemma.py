@@ -28,72 +28,1883 @@ import shutil
 import sys
 import ConfigParser
 import argparse
-
+import base64
+import cProfile
+import calendar
+import contextlib
+import hashlib
+import httplib
+import json
+import marshal
+import mmap
+import multiprocessing
+import re
+import sqlite3
+import sre_parse
+import time
+import urllib2
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from lxml import etree
+from multiprocessing.pool import ThreadPool
 from os.path import join as pjoin
-from saml2.assertion import Policy
-from saml2.attribute_converter import ac_factory
-from saml2.md import AssertionConsumerService
-from saml2.md import SingleLogoutService
-from saml2.mdie import from_dict
-
-from saml2.mdstore import MetadataStore
 from string import Template
-from saml2.sigver import split_len, active_cert
-
-import xmldsig
-import xmlenc
-from saml2 import md
-from saml2 import config
-from saml2 import BINDING_HTTP_ARTIFACT
-from saml2 import BINDING_SOAP
-from saml2 import BINDING_PAOS
-from saml2 import saml
-from saml2.extension import dri
-from saml2.extension import idpdisc
-from saml2.extension import mdattr
-from saml2.extension import mdrpi
-from saml2.extension import mdui
-from saml2.extension import shibmd
-from saml2.extension import ui
-
-ONTS = {
-    saml.NAMESPACE: saml,
-    mdui.NAMESPACE: mdui,
-    mdattr.NAMESPACE: mdattr,
-    dri.NAMESPACE: dri,
-    ui.NAMESPACE: ui,
-    idpdisc.NAMESPACE: idpdisc,
-    md.NAMESPACE: md,
-    xmldsig.NAMESPACE: xmldsig,
-    xmlenc.NAMESPACE: xmlenc,
-    mdrpi.NAMESPACE: mdrpi,
-    shibmd.NAMESPACE: shibmd
-}
-
-ATTRCONV = ac_factory("./attributemaps")
+
+# pySAML2 is imported where it is needed, most of it is not needed for every
+# command and importing it takes a noticeable time
+
+MD_NAMESPACE = "urn:oasis:names:tc:SAML:2.0:metadata"
+DS_NAMESPACE = "http://www.w3.org/2000/09/xmldsig#"
+SAML_NAMESPACE = "urn:oasis:names:tc:SAML:2.0:assertion"
+MDATTR_NAMESPACE = "urn:oasis:names:tc:SAML:metadata:attribute"
+MDRPI_NAMESPACE = "urn:oasis:names:tc:SAML:metadata:rpi"
+
+_ONTS = None
+
+
+def onts():
+    """
+    The modules of the namespaces used in metadata, keyed by namespace,
+    imported on first use
+    """
+    global _ONTS
+    if _ONTS is None:
+        import xmldsig
+        import xmlenc
+        from saml2 import md
+        from saml2 import saml
+        from saml2.extension import dri
+        from saml2.extension import idpdisc
+        from saml2.extension import mdattr
+        from saml2.extension import mdrpi
+        from saml2.extension import mdui
+        from saml2.extension import shibmd
+        from saml2.extension import ui
+
+        _ONTS = {
+            saml.NAMESPACE: saml,
+            mdui.NAMESPACE: mdui,
+            mdattr.NAMESPACE: mdattr,
+            dri.NAMESPACE: dri,
+            ui.NAMESPACE: ui,
+            idpdisc.NAMESPACE: idpdisc,
+            md.NAMESPACE: md,
+            xmldsig.NAMESPACE: xmldsig,
+            xmlenc.NAMESPACE: xmlenc,
+            mdrpi.NAMESPACE: mdrpi,
+            shibmd.NAMESPACE: shibmd
+        }
+    return _ONTS
+
+ATTRIBUTE_MAPS = "./attributemaps"
+_ATTRCONV = None
+
+
+def _attribute_maps(path):
+    """
+    Collects the maps in the modules of an attribute map directory, the way
+    ac_factory does, without importing them as modules.
+    """
+    maps = []
+    for fil in sorted(os.listdir(path)):
+        if fil.endswith(".py"):
+            glb = {}
+            execfile(pjoin(path, fil), glb)
+            for key, item in glb.items():
+                if key.startswith("__"):
+                    continue
+                if isinstance(item, dict) and "to" in item and "fro" in item:
+                    maps.append(item)
+    return maps
+
+
+def attribute_converters(path=ATTRIBUTE_MAPS, cache_file=None):
+    """
+    Returns the attribute converters for the maps in path. They are built on
+    first use only. The maps themselves are kept in cache_file in marshal
+    form, which is used as long as none of the map modules has changed.
+
+    :param path: Directory with the attribute maps
+    :param cache_file: Where to keep the maps between runs
+    :return: list of AttributeConverter instances
+    """
+    global _ATTRCONV
+    if _ATTRCONV is not None:
+        return _ATTRCONV
+    from saml2.attribute_converter import AttributeConverter
+
+    signature = []
+    for fil in sorted(os.listdir(path)):
+        if fil.endswith(".py"):
+            stat = os.stat(pjoin(path, fil))
+            signature.append((fil, stat.st_mtime, stat.st_size))
+    maps = None
+    if cache_file:
+        try:
+            fp = open(cache_file, "rb")
+            try:
+                cached = marshal.load(fp)
+            finally:
+                fp.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            cached = None
+        if isinstance(cached, dict) and cached.get("signature") == signature:
+            maps = cached["maps"]
+    if maps is None:
+        maps = _attribute_maps(path)
+        if cache_file:
+            fp = open(cache_file, "wb")
+            marshal.dump({"signature": signature, "maps": maps}, fp)
+            fp.close()
+
+    _ATTRCONV = []
+    for item in maps:
+        atco = AttributeConverter(item["identifier"])
+        atco.from_dict(item)
+        _ATTRCONV.append(atco)
+    return _ATTRCONV
 
 
 ENTITY_ATTRIBUTES = 'urn:oasis:names:tc:SAML:metadata:attribute&EntityAttributes'
 ENTITY_CATEGORY = 'http://macedir.org/entity-category'
+REGISTRATION_INFO = 'urn:oasis:names:tc:SAML:metadata:rpi&RegistrationInfo'
 
 
 # -----------------------------------------------------------------------------
 
 BINDINGS_NOT_SUPPORTED = [
-    BINDING_HTTP_ARTIFACT, BINDING_SOAP, BINDING_PAOS,
+    'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Artifact',
+    'urn:oasis:names:tc:SAML:2.0:bindings:SOAP',
+    'urn:oasis:names:tc:SAML:2.0:bindings:PAOS',
     'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST-SimpleSign',
     'urn:oasis:names:tc:SAML:1.0:profiles:browser-post',
     'urn:oasis:names:tc:SAML:1.0:profiles:artifact-01'
 ]
 
-SEVICES_NOT_SUPPORTED = [
-    AssertionConsumerService, SingleLogoutService
-]
-
 DIR = {"metadata": "entities-temp", "ruleset": "ruleset-temp",
-       "template": "templates"}
-TPL = ["ruleset_persistent", "ruleset_transient",
-       "powershell_metadata_update", "powershell_base"]
+       "template": "templates", "cache": "cache"}
+# The directories that are written to the output directory
+OUTPUT_DIR = ["metadata", "ruleset"]
+PS1_FILE = "update_adfs_rptrust.ps1"
+TPL = ["ruleset_persistent", "ruleset_transient", "rule_",
+       "powershell_metadata_update", "powershell_base",
+       "powershell_incremental_base", "powershell_add", "powershell_update",
+       "powershell_remove", "powershell_commit"]
+STATE_FILE = "state.db"
+CERT_CACHE_FILE = "certs.json"
+# The cache of the first remote source, those of the others are numbered
+METADATA_NAME = "metadata"
+SIGNATURE_CACHE_FILE = "signatures.json"
+ATTRIBUTE_MAP_CACHE_FILE = "attributemaps.marshal"
+
+
+class MetadataError(Exception):
+    pass
+
+
+DURATION = re.compile(
+    r"^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?"
+    r"(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d*)?)S)?)?$")
+DURATION_UNITS = [365 * 86400, 30 * 86400, 86400, 3600, 60, 1]
+
+
+def duration_seconds(duration):
+    """
+    Converts a xs:duration, like a cacheDuration, to seconds.
+
+    :return: The number of seconds or None if the duration can't be parsed
+    """
+    _match = DURATION.match(duration.strip())
+    if not _match:
+        return None
+    return sum([float(val) * unit for val, unit in zip(_match.groups(),
+                                                       DURATION_UNITS) if val])
+
+
+def root_attributes(filename):
+    """
+    Returns the attributes of the root element of a metadata document
+    without parsing the rest of it.
+    """
+    for _, elem in etree.iterparse(filename, events=("start",),
+                                   resolve_entities=False, no_network=True):
+        return dict(elem.attrib)
+    return {}
+
+
+class MetadataCache(object):
+    """
+    Local copy of remote metadata together with the ETag and Last-Modified
+    values needed to make conditional requests for it.
+    """
+    def __init__(self, directory, url, proxy="", name=METADATA_NAME):
+        self.filename = pjoin(directory, name + ".xml")
+        self.info_file = pjoin(directory, name + ".json")
+        self.url = url
+        self.proxy = proxy
+        self.info = {}
+
+    def load(self):
+        try:
+            fp = open(self.info_file, "r")
+        except IOError:
+            return
+        try:
+            self.info = json.load(fp)
+        except ValueError:
+            self.info = {}
+        fp.close()
+
+    def save(self):
+        fp = open(self.info_file, "w")
+        json.dump(self.info, fp, sort_keys=True, indent=1)
+        fp.close()
+
+    def fresh(self):
+        """
+        Whether the local copy of the metadata can be used without asking
+        the server, according to its cacheDuration and validUntil.
+        """
+        from saml2.time_util import valid
+
+        if (self.info.get("url") != self.url or
+                not os.path.exists(self.filename)):
+            return False
+        attr = root_attributes(self.filename)
+        try:
+            cache_duration = duration_seconds(attr["cacheDuration"])
+        except KeyError:
+            return False
+        if cache_duration is None:
+            return False
+        if "validUntil" in attr and not valid(attr["validUntil"]):
+            return False
+        return time.time() < self.info["fetched"] + cache_duration
+
+    def expires(self):
+        """
+        When the local copy should be refreshed, according to its
+        cacheDuration and validUntil.
+
+        :return: Seconds since the epoch or None if the metadata doesn't say
+        """
+        from saml2.time_util import str_to_time
+
+        if "fetched" not in self.info or not os.path.exists(self.filename):
+            return None
+        attr = root_attributes(self.filename)
+        res = []
+        try:
+            cache_duration = duration_seconds(attr["cacheDuration"])
+        except KeyError:
+            pass
+        else:
+            if cache_duration is not None:
+                res.append(self.info["fetched"] + cache_duration)
+        if "validUntil" in attr:
+            res.append(calendar.timegm(str_to_time(attr["validUntil"])))
+        if res:
+            return min(res)
+        return None
+
+    def fetch(self):
+        """
+        Fetches the metadata unless the server says that the local copy is
+        still current.
+
+        :return: True if a new document was downloaded
+        """
+        url = self.url
+        if self.info.get("url") != url or not os.path.exists(self.filename):
+            self.info = {"url": url}
+        request = urllib2.Request(url)
+        if "etag" in self.info:
+            request.add_header("If-None-Match", self.info["etag"])
+        if "last_modified" in self.info:
+            request.add_header("If-Modified-Since", self.info["last_modified"])
+        if self.proxy:
+            opener = urllib2.build_opener(urllib2.ProxyHandler(
+                {"http": self.proxy, "https": self.proxy}))
+        else:
+            opener = urllib2.build_opener()
+        try:
+            response = opener.open(request)
+        except urllib2.HTTPError, err:
+            if err.code == 304:
+                self.info["fetched"] = time.time()
+                self.save()
+                return False
+            raise MetadataError("fetching %s failed: %s" % (url, err))
+        except urllib2.URLError, err:
+            raise MetadataError("fetching %s failed: %s" % (url, err.reason))
+        except httplib.HTTPException, err:
+            raise MetadataError("fetching %s failed: %r" % (url, err))
+
+        _tmp = self.filename + ".tmp"
+        fp = open(_tmp, "wb")
+        shutil.copyfileobj(response, fp)
+        fp.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        os.rename(_tmp, self.filename)
+
+        self.info = {"url": url, "fetched": time.time(), "extracted": False}
+        headers = response.info()
+        if headers.getheader("ETag"):
+            self.info["etag"] = headers.getheader("ETag")
+        if headers.getheader("Last-Modified"):
+            self.info["last_modified"] = headers.getheader("Last-Modified")
+        response.close()
+        self.save()
+        return True
+
+    def extracted(self):
+        """
+        Records that the local copy has been run through extract
+        """
+        self.info["extracted"] = True
+        self.save()
+
+
+def fetch_metadata(caches):
+    """
+    Brings the local copies of several remote sources up to date at the
+    same time, each in its own thread, so that the slowest server sets the
+    time taken instead of the sum of all of them.
+
+    :return: For every cache, whether a new document was downloaded
+    """
+    def _fetch(mdcache):
+        if mdcache.fresh():
+            return False
+        return mdcache.fetch()
+
+    if len(caches) == 1:
+        return [_fetch(caches[0])]
+    pool = ThreadPool(len(caches))
+    try:
+        return pool.map(_fetch, caches)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SignatureCache(object):
+    """
+    Remembers the metadata documents whose signature has been verified, keyed
+    by the SHA-256 digest of the document together with that of the
+    certificate file, so that xmlsec isn't run again for the same bytes.
+    Replacing the certificate file invalidates the entries.
+    """
+    max_entries = 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entry = {}
+
+    def load(self):
+        try:
+            fp = open(self.filename, "r")
+        except IOError:
+            return
+        try:
+            self.entry = json.load(fp)
+        except ValueError:
+            self.entry = {}
+        fp.close()
+
+    def save(self):
+        fp = open(self.filename, "w")
+        json.dump(self.entry, fp, sort_keys=True, indent=1)
+        fp.close()
+
+    def key(self, data, cert):
+        fp = open(cert, "rb")
+        cert_digest = hashlib.sha256(fp.read()).hexdigest()
+        fp.close()
+        return "%s:%s" % (hashlib.sha256(data).hexdigest(), cert_digest)
+
+    def add(self, key):
+        self.entry[key] = time.time()
+        # only the most recently verified documents are kept
+        for _key in sorted(self.entry.keys(), key=self.entry.get,
+                           reverse=True)[self.max_entries:]:
+            del self.entry[_key]
+        self.save()
+
+
+class OutputWriter(object):
+    """
+    Writes the files of a run into a staging directory inside the output
+    directory and moves them into place once the run is complete, so that a
+    failed run never leaves a half populated tree behind for the powershell
+    step. Files are synced to disk in batches, and the script is moved into
+    place last.
+    """
+    sync_batch = 64
+
+    def __init__(self, directory, dirs, script):
+        self.directory = directory
+        self.dirs = dirs
+        self.script = script
+        self.staging = pjoin(directory, ".staging")
+        self.old = pjoin(directory, ".old")
+        self._unsynced = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_unsynced"] = []
+        return state
+
+    def start(self):
+        shutil.rmtree(self.staging, True)
+        for name in self.dirs:
+            os.makedirs(pjoin(self.staging, name))
+
+    def staged(self, path):
+        """
+        Maps the final location of a file to where it is staged
+        """
+        return pjoin(self.staging, os.path.relpath(path, self.directory))
+
+    def write(self, path, data):
+        """
+        :param path: The final location of the file
+        :param data: The content
+        """
+        fp = open(self.staged(path), "w")
+        fp.write(data)
+        fp.flush()
+        self._unsynced.append(fp)
+        if len(self._unsynced) >= self.sync_batch:
+            self.sync()
+
+    def sync(self):
+        for fp in self._unsynced:
+            os.fsync(fp.fileno())
+            fp.close()
+        self._unsynced = []
+
+    def commit(self, script=None):
+        """
+        Moves the staged directories into place, replacing those of the
+        previous run, followed by the script if there is one.
+
+        :param script: The text of the powershell script
+        """
+        if script is not None:
+            self.write(pjoin(self.directory, self.script), script)
+        self.sync()
+        shutil.rmtree(self.old, True)
+        os.mkdir(self.old)
+        # The script of the previous run goes first, it must not be run
+        # against the new files
+        for name in [self.script] + self.dirs:
+            if os.path.exists(pjoin(self.directory, name)):
+                os.rename(pjoin(self.directory, name), pjoin(self.old, name))
+        for name in self.dirs:
+            os.rename(pjoin(self.staging, name), pjoin(self.directory, name))
+        if script is not None:
+            os.rename(pjoin(self.staging, self.script),
+                      pjoin(self.directory, self.script))
+        self._sync_directory()
+        shutil.rmtree(self.old, True)
+        shutil.rmtree(self.staging, True)
+
+    def _sync_directory(self):
+        # Makes the renames durable, not possible on Windows
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        os.close(fd)
+
+    def clean_up(self):
+        shutil.rmtree(self.staging, True)
+        shutil.rmtree(self.old, True)
+
+
+if sys.platform == "win32":
+    def cpu_time():
+        return sum(os.times()[:2])
+else:
+    # CPU time with better resolution than os.times
+    cpu_time = time.clock
+
+
+class Profiler(object):
+    """
+    Records wall clock time, CPU time and counts per phase of a run and per
+    entity. Phases entered while an entity is being handled are recorded for
+    that entity, the entity records are then added to the totals with
+    add_entity, also when they come back from worker processes.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self.entities = []
+        self._entity = None
+        self.started = time.time()
+        self.cpu_started = cpu_time()
+
+    @staticmethod
+    def _add(phases, name, wall, cpu):
+        try:
+            phase = phases[name]
+        except KeyError:
+            phase = phases[name] = {"wall": 0.0, "cpu": 0.0, "count": 0}
+        phase["wall"] += wall
+        phase["cpu"] += cpu
+        phase["count"] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            if self._entity is not None:
+                phases = self._entity["phases"]
+            else:
+                phases = self.phases
+            self._add(phases, name, time.time() - wall, cpu_time() - cpu)
+
+    def iterate(self, name, iterable):
+        """
+        Records the time spent producing the items of iterable as a phase,
+        used for the parsing done by a MetadataStream.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def start_entity(self, eid):
+        if self.enabled:
+            self._entity = {"eid": eid, "phases": {}, "wall": time.time(),
+                            "cpu": cpu_time()}
+
+    def end_entity(self):
+        """
+        :return: The record of the entity, None if not enabled
+        """
+        record = self._entity
+        if record is not None:
+            record["wall"] = time.time() - record["wall"]
+            record["cpu"] = cpu_time() - record["cpu"]
+            self._entity = None
+        return record
+
+    def add_entity(self, record):
+        if record is None:
+            return
+        self.entities.append(record)
+        for name, phase in record["phases"].items():
+            try:
+                total = self.phases[name]
+            except KeyError:
+                total = self.phases[name] = {"wall": 0.0, "cpu": 0.0,
+                                             "count": 0}
+            for key in ["wall", "cpu", "count"]:
+                total[key] += phase[key]
+
+    def report(self, top=20):
+        """
+        :param top: Number of the slowest entities to include
+        :return: dictionary with the totals, the phases, the slowest entities
+            and the peak resident set size, as reported by getrusage
+            (kilobytes on Linux)
+        """
+        slowest = sorted(self.entities, key=lambda r: r["wall"],
+                         reverse=True)[:top]
+        if resource is not None:
+            peak_rss = {
+                "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "children": resource.getrusage(
+                    resource.RUSAGE_CHILDREN).ru_maxrss}
+        else:
+            peak_rss = None
+        return {
+            "total": {"wall": time.time() - self.started,
+                      "cpu": cpu_time() - self.cpu_started},
+            "phases": self.phases,
+            "entities": {
+                "count": len(self.entities),
+                "wall": sum([r["wall"] for r in self.entities]),
+                "cpu": sum([r["cpu"] for r in self.entities]),
+                "slowest": slowest},
+            "peak_rss": peak_rss}
+
+    def save(self, filename, top=20):
+        fp = open(filename, "w")
+        json.dump(self.report(top), fp, sort_keys=True, indent=1)
+        fp.close()
+
+
+def map_file(filename):
+    """
+    Maps a file read-only into memory. Its pages are read as they are used
+    and shared with the page cache, instead of copying all of it into a
+    string.
+
+    :return: mmap object, or an empty string for an empty file
+    """
+    fp = open(filename, "rb")
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # An empty file can't be mapped
+        return ""
+    finally:
+        fp.close()
+
+
+def verify_signature(sec_config, filename, cert, cache=None):
+    """
+    Verifies the signature of a metadata aggregate stored in a file.
+
+    :param sec_config: pySAML2 configuration with the xmlsec binary
+    :param filename: Name of the file holding the metadata
+    :param cert: Certificate the aggregate should be signed with
+    :param cache: SignatureCache with documents that have already verified
+    :return: True if the signature verified
+    """
+    data = map_file(filename)
+    try:
+        if cache is not None:
+            key = cache.key(data, cert)
+            if key in cache.entry:
+                print "Signature of %s already verified" % filename
+                return True
+        txt = data[:]
+    finally:
+        if data:
+            data.close()
+    from saml2.sigver import security_context
+
+    res = security_context(sec_config).verify_signature(
+        txt, cert_file=cert, node_name="%s:EntitiesDescriptor" % MD_NAMESPACE)
+    if res and cache is not None:
+        cache.add(key)
+    return res
+
+
+_ATTRIBUTES = r"""((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*)\s*(/?)>"""
+XML_ENCODING_RE = re.compile(r"""<\?xml[^>]*encoding\s*=\s*["']([^"']+)""")
+ROOT_TAG_RE = re.compile(
+    r"<!--.*?-->|<\?.*?\?>|<(!DOCTYPE)|<([^\s/>!?]+)" + _ATTRIBUTES, re.S)
+ENTITY_TAG_RE = re.compile(
+    r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|"
+    r"<(/?)((?:[\w.-]+:)?(Entity|Entities)Descriptor)" + _ATTRIBUTES, re.S)
+
+
+def split_entities(data):
+    """
+    Finds the EntityDescriptor elements in the text of a metadata aggregate
+    without parsing it.
+
+    :param data: The metadata document, a string or a mapped file
+    :return: The start tag and the name of the root element, and the
+        (start, end) offsets of the EntityDescriptor elements
+    :raise ValueError: If the document can't be split like this
+    """
+    match = XML_ENCODING_RE.match(data)
+    if match and match.group(1).lower() not in ("utf-8", "utf8", "ascii",
+                                                "us-ascii"):
+        raise ValueError("encoding %s" % match.group(1))
+    for match in ROOT_TAG_RE.finditer(data):
+        if match.group(1):
+            raise ValueError("document type declaration")
+        if match.group(2):
+            break
+    else:
+        raise ValueError("no root element")
+    root = match
+    ranges = []
+    start = None
+    for match in ENTITY_TAG_RE.finditer(data, root.start()):
+        closing, name, kind, attributes, empty = match.groups()
+        if name is None:
+            # A comment or CDATA section
+            continue
+        if kind == "Entities":
+            # The root start tag is put around every element, namespaces
+            # declared further down would be missing
+            if (not closing and match.start() != root.start() and
+                    "xmlns" in attributes):
+                raise ValueError("namespace declared on %s" % name)
+        elif closing:
+            if start is None:
+                raise ValueError("unbalanced %s" % name)
+            ranges.append((start, match.end()))
+            start = None
+        elif start is not None:
+            raise ValueError("nested %s" % name)
+        elif empty:
+            ranges.append((match.start(), match.end()))
+        else:
+            start = match.start()
+    if start is not None:
+        raise ValueError("unterminated EntityDescriptor")
+    return root.group(0), root.group(2), ranges
+
+
+def c14n_digest(elem):
+    """
+    :return: hex digest of the exclusive canonical form of an element
+    """
+    return hashlib.sha256(etree.tostring(
+        elem, method="c14n", exclusive=True, with_comments=False)).hexdigest()
+
+
+class MetadataStream(object):
+    """
+    Reads metadata aggregates one EntityDescriptor at a time and only keeps
+    the Service Providers, instead of building the whole MetadataStore in
+    memory. Offers the part of the MetadataStore interface that Femma uses.
+
+    The exclusive canonical digest of every Service Provider is kept in
+    digests. When unchanged is set, the aggregate is split into the byte
+    ranges of its EntityDescriptor elements instead, and only the Service
+    Providers that unchanged has no record for are handed out; the records
+    of the others are collected in skipped.
+
+    A Service Provider that is in more than one of the files is taken from
+    the first file that has a valid copy of it.
+    """
+    def __init__(self, filenames, check_validity=True, raw=False):
+        self.filenames = filenames
+        self.check_validity = check_validity
+        # Hand out the serialized EntityDescriptor, together with what the
+        # rulesets depend on, instead of the full dictionary form
+        self.raw = raw
+        # Called with the entityID and the digest of a Service Provider,
+        # returns the SPRecord of the previous run if nothing has changed
+        self.unchanged = None
+        self.skipped = []
+        self.digests = {}
+        self.duplicates = 0
+
+    def items(self):
+        for filename in self.filenames:
+            self.duplicates = 0
+            for item in self._file_items(filename):
+                yield item
+            report_duplicates(filename, self.duplicates)
+
+    def _file_items(self, filename):
+        if self.unchanged is not None:
+            data = map_file(filename)
+            try:
+                split = split_entities(data)
+            except ValueError, e:
+                print "WARNING: can't split %s (%s), all of it is " \
+                      "processed" % (filename, e)
+            else:
+                for item in self._split_items(filename, data, *split):
+                    yield item
+                return
+            finally:
+                # Or the file couldn't be replaced on Windows
+                if data:
+                    data.close()
+        for item in self._items(filename):
+            yield item
+
+    def _check_root(self, filename, root):
+        from saml2.time_util import valid
+
+        _valid_until = root.get("validUntil")
+        if self.check_validity and _valid_until and not valid(_valid_until):
+            raise MetadataError("Metadata in %s not valid after %s" % (
+                filename, _valid_until))
+
+    def _entity(self, elem):
+        """
+        :param elem: EntityDescriptor element of a Service Provider
+        :return: The entityID and the form handed out, or None if the
+            entity is no longer valid
+        """
+        from saml2 import md
+        from saml2.mdstore import to_dict
+        from saml2.time_util import valid
+
+        if self.raw:
+            _valid_until = elem.get("validUntil")
+            if not (self.check_validity and _valid_until and
+                    not valid(_valid_until)):
+                entity = element_summary(elem)
+                entity["xml"] = etree.tostring(elem, with_tail=False)
+                return entity["entity_id"], entity
+        else:
+            entity = md.entity_descriptor_from_string(
+                etree.tostring(elem, with_tail=False))
+            if not (self.check_validity and entity.valid_until and
+                    not valid(entity.valid_until)):
+                return entity.entity_id, to_dict(entity, onts().values())
+        return None
+
+    def _items(self, filename):
+        _ed = "{%s}EntityDescriptor" % MD_NAMESPACE
+        root = None
+        # The metadata may not be signed, so libxml2 keeps its limits on
+        # the size of the document and nothing is loaded from elsewhere
+        for event, elem in etree.iterparse(filename, events=("start", "end"),
+                                           resolve_entities=False,
+                                           no_network=True):
+            if root is None:
+                root = elem
+                # Entities declared in it would still be expanded in
+                # attribute values, and the split path refuses it as well
+                if root.getroottree().docinfo.internalDTD is not None:
+                    raise MetadataError("%s has a document type declaration"
+                                        % filename)
+                self._check_root(filename, root)
+            if event != "end" or elem.tag != _ed:
+                continue
+            if elem.find(MD_SPSSO) is not None:
+                eid = elem.get("entityID")
+                if eid in self.digests:
+                    self.duplicates += 1
+                else:
+                    digest = c14n_digest(elem)
+                    item = self._entity(elem)
+                    if item is not None:
+                        self.digests[eid] = digest
+                        yield item
+            # Drop what has been handled, memory use is then bounded by the
+            # size of the largest entity
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    def _split_items(self, filename, data, root_tag, root_name, ranges):
+        if root_tag.endswith("/>"):
+            return
+        end_tag = "</%s>" % root_name
+        self._check_root(filename, etree.fromstring(root_tag + end_tag))
+        parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        for start, end in ranges:
+            if data.find("SPSSODescriptor", start, end) < 0:
+                continue
+            # Parsed within the start tag of the root, for its namespace
+            # declarations
+            try:
+                elem = etree.fromstring(root_tag + data[start:end] + end_tag,
+                                        parser)[0]
+            except etree.XMLSyntaxError, e:
+                raise MetadataError("%s at offset %d: %s" % (filename,
+                                                             start, e))
+            if elem.find(MD_SPSSO) is None:
+                continue
+            eid = elem.get("entityID")
+            if eid in self.digests:
+                self.duplicates += 1
+                continue
+            digest = c14n_digest(elem)
+            # Whether it is still valid is not known without looking
+            if elem.get("validUntil") is None:
+                record = self.unchanged(eid, digest)
+                if record is not None:
+                    self.digests[eid] = digest
+                    self.skipped.append(record)
+                    continue
+            item = self._entity(elem)
+            if item is not None:
+                self.digests[eid] = digest
+                yield item
+
+
+class MergedMetadataStore(object):
+    """
+    The entities of the documents loaded into a MetadataStore, in the order
+    they were loaded. A Service Provider that is in more than one of them
+    is taken from the first, MetadataStore.items() merges the documents in
+    no particular order.
+    """
+    def __init__(self, mds, keys):
+        self.mds = mds
+        self.keys = keys
+
+    def items(self):
+        seen = set()
+        for key in self.keys:
+            duplicates = 0
+            for eid, entity in self.mds.metadata[key].items():
+                if "spsso_descriptor" in entity:
+                    if eid in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(eid)
+                yield eid, entity
+            report_duplicates(key, duplicates)
+
+
+def report_duplicates(filename, count):
+    if count:
+        print "%d Service Providers in %s are overridden by an earlier " \
+              "source" % (count, filename)
+
+
+def entity_digest(entity, ruleset):
+    """
+    Computes a content hash over the filtered entity descriptor and the
+    ruleset computed for it.
+
+    :param entity: Entity descriptor as a dictionary or as serialized XML
+    :param ruleset: The ruleset text
+    :return: hex digest
+    """
+    if isinstance(ruleset, unicode):
+        ruleset = ruleset.encode("utf-8")
+    if isinstance(entity, str):
+        _hash = hashlib.sha256(entity)
+    else:
+        _hash = hashlib.sha256(json.dumps(entity, sort_keys=True))
+    _hash.update(ruleset)
+    return _hash.hexdigest()
+
+
+def _qname(namespace, tag):
+    return "{%s}%s" % (namespace, tag)
+
+
+MD_SPSSO = _qname(MD_NAMESPACE, "SPSSODescriptor")
+MD_KEY_DESCRIPTOR = _qname(MD_NAMESPACE, "KeyDescriptor")
+MD_ACS = _qname(MD_NAMESPACE, "AssertionConsumerService")
+MD_SLS = _qname(MD_NAMESPACE, "SingleLogoutService")
+MD_EXTENSIONS = _qname(MD_NAMESPACE, "Extensions")
+DS_KEY_INFO = _qname(DS_NAMESPACE, "KeyInfo")
+DS_KEY_NAME = _qname(DS_NAMESPACE, "KeyName")
+DS_X509_DATA = _qname(DS_NAMESPACE, "X509Data")
+DS_X509_CERTIFICATE = _qname(DS_NAMESPACE, "X509Certificate")
+MDATTR_ENTITY_ATTRIBUTES = _qname(MDATTR_NAMESPACE, "EntityAttributes")
+MDRPI_REGISTRATION_INFO = _qname(MDRPI_NAMESPACE, "RegistrationInfo")
+SAML_ATTRIBUTE = _qname(SAML_NAMESPACE, "Attribute")
+SAML_ATTRIBUTE_VALUE = _qname(SAML_NAMESPACE, "AttributeValue")
+
+
+def element_summary(elem):
+    """
+    Picks the parts of an EntityDescriptor element the ruleset depends on,
+    shaped like the dictionary form so the rule lookups can be shared.
+
+    :param elem: EntityDescriptor element
+    :return: dictionary with the entity_id and the extensions
+    """
+    res = {"entity_id": elem.get("entityID")}
+    extensions = elem.find(MD_EXTENSIONS)
+    if extensions is not None:
+        ext_elems = []
+        for child in extensions:
+            if child.tag == MDRPI_REGISTRATION_INFO:
+                ext_elems.append({
+                    "__class__": REGISTRATION_INFO,
+                    "registration_authority": child.get(
+                        "registrationAuthority")})
+            elif child.tag == MDATTR_ENTITY_ATTRIBUTES:
+                ext_elems.append({
+                    "__class__": ENTITY_ATTRIBUTES,
+                    "attribute": [
+                        {"name": attr.get("Name"),
+                         "attribute_value": [
+                             {"text": val.text} for val in
+                             attr.findall(SAML_ATTRIBUTE_VALUE)]}
+                        for attr in child.findall(SAML_ATTRIBUTE)]})
+        res["extensions"] = {"extension_elements": ext_elems}
+    return res
+
+
+XSI_TYPE = "{http://www.w3.org/2001/XMLSchema-instance}type"
+
+
+def _element_key(elem):
+    attrib = dict(elem.attrib)
+    # pySAML2 types attribute values explicitly, untyped text is a string
+    if attrib.get(XSI_TYPE, "").endswith(":string"):
+        del attrib[XSI_TYPE]
+    return (elem.tag, sorted(attrib.items()), (elem.text or "").strip(),
+            [_element_key(child) for child in elem
+             if isinstance(child.tag, basestring)])
+
+
+def xml_equivalent(xml1, xml2):
+    """
+    Compares two serializations of an element tree, ignoring namespace
+    prefixes, attribute order, comments, whitespace around text and
+    explicit string typing.
+
+    :return: True if they describe the same elements
+    """
+    return _element_key(etree.fromstring(xml1)) == _element_key(
+        etree.fromstring(xml2))
+
+
+def _cert_text(text):
+    return "".join((text or "").split())
+
+
+def entity_fields(entity):
+    """
+    Picks the keys and endpoints of a filtered entity descriptor, in the
+    same form as element_fields.
+
+    :param entity: Entity descriptor as a dictionary
+    :return: dictionary with the sorted keys, acs and slo values
+    """
+    res = {"keys": [], "acs": [], "slo": []}
+    for sp in entity["spsso_descriptor"]:
+        for kd in sp.get("key_descriptor", []):
+            for x in kd["key_info"].get("x509_data", []):
+                res["keys"].append(
+                    [kd.get("use", ""),
+                     _cert_text(x["x509_certificate"]["text"])])
+        for acs in sp["assertion_consumer_service"]:
+            res["acs"].append([acs["binding"], acs["location"],
+                               acs.get("index", "")])
+        for sls in sp.get("single_logout_service", []):
+            res["slo"].append([sls["binding"], sls["location"]])
+    for value in res.values():
+        value.sort()
+    return res
+
+
+def element_fields(elem):
+    """
+    Same as entity_fields but for a filtered EntityDescriptor element.
+    """
+    res = {"keys": [], "acs": [], "slo": []}
+    for sp in elem.findall(MD_SPSSO):
+        for kd in sp.findall(MD_KEY_DESCRIPTOR):
+            for xc in kd.findall("%s/%s/%s" % (DS_KEY_INFO, DS_X509_DATA,
+                                               DS_X509_CERTIFICATE)):
+                res["keys"].append([kd.get("use", ""), _cert_text(xc.text)])
+        for acs in sp.findall(MD_ACS):
+            res["acs"].append([acs.get("Binding"), acs.get("Location"),
+                               acs.get("index", "")])
+        for sls in sp.findall(MD_SLS):
+            res["slo"].append([sls.get("Binding"), sls.get("Location")])
+    for value in res.values():
+        value.sort()
+    return res
+
+
+# What a plan reports when the digest of a part of a Service Provider changed
+PLAN_REASONS = [("keys", "key rotated"), ("acs", "ACS changed"),
+                ("slo", "SLO changed"), ("rules", "attribute set changed")]
+FIELDS = [name for name, reason in PLAN_REASONS]
+
+
+def field_digests(fields, ruleset):
+    """
+    Computes a hash per part of a Service Provider that a plan reports on,
+    so that a change can be explained without keeping the metadata of the
+    previous run.
+
+    :param fields: The keys and endpoints, from entity_fields or
+        element_fields
+    :param ruleset: The ruleset text
+    :return: tuple of hex digests, in the order of FIELDS
+    """
+    if isinstance(ruleset, unicode):
+        ruleset = ruleset.encode("utf-8")
+    res = dict([(name, hashlib.sha256(json.dumps(value)).hexdigest())
+                for name, value in fields.items()])
+    res["rules"] = hashlib.sha256(ruleset).hexdigest()
+    return tuple([res[name] for name in FIELDS])
+
+
+class SPRecord(object):
+    """
+    What is kept of an entity once process_entity is done with it. There is
+    one for every Service Provider in the metadata until the powershell
+    script has been generated, so it has slots instead of a dictionary and
+    keeps the file name rather than the paths made from it. The certificate
+    journal and the profile are dropped as soon as they have been merged.
+    """
+    __slots__ = ("eid", "fname", "digest", "fields", "ruleset_key",
+                 "written", "outcome", "certs", "profile", "source",
+                 "recheck", "fingerprints")
+
+    def __init__(self, eid, certs, outcome=None):
+        self.eid = eid
+        self.certs = certs
+        self.outcome = outcome
+        self.fname = None
+        self.digest = None
+        self.fields = None
+        self.ruleset_key = None
+        self.written = False
+        self.profile = None
+        # The canonical digest of the metadata the record was made from and
+        # when the validity of its certificates changes next
+        self.source = None
+        self.recheck = None
+        # The certificates looked up, kept in the certificate cache while
+        # the record is reused
+        self.fingerprints = None
+
+    # Slots are not pickled by default, records come back from the workers
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS run (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    script INTEGER NOT NULL DEFAULT 0,
+    context TEXT
+);
+CREATE TABLE IF NOT EXISTS entity (
+    entity_id TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    run INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    digest TEXT,
+    fields TEXT,
+    fname TEXT,
+    metadata_file TEXT,
+    ruleset_file TEXT,
+    ruleset_key TEXT,
+    source_digest TEXT,
+    recheck_after REAL,
+    certs TEXT,
+    pending_digest TEXT,
+    pending_fields TEXT,
+    pending_fname TEXT,
+    deployed_digest TEXT,
+    deployed_fields TEXT,
+    deployed_fname TEXT
+);
+CREATE INDEX IF NOT EXISTS entity_run ON entity (run);
+CREATE INDEX IF NOT EXISTS entity_outcome ON entity (outcome);
+CREATE INDEX IF NOT EXISTS entity_deployed ON entity (deployed_digest);
+"""
+
+class StateStore(object):
+    """
+    Keeps a row per Service Provider entityID in an SQLite database: when it
+    was first and last seen, what the last run made of it (exported, No
+    working keys, No working endpoints or excluded, with the content digest
+    and output files) and what its relying party trust in ADFS was made
+    from.
+
+    When a run generates a powershell script its rows are set aside as
+    pending, and the script moves a marker holding the number of the run
+    into place as its last action. The pending rows only become the
+    deployed state once it has, so that the state only advances when the
+    relying party trusts have actually been updated.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending_filename = filename + ".pending"
+        self.deployed_filename = filename + ".deployed"
+        self.db = None
+        self.run = None
+        # The previous run that recorded its state, and what it depended on
+        self.last_run = None
+        self.context = None
+
+    def __getstate__(self):
+        # Worker processes are handed the deployed digest with the entity
+        state = self.__dict__.copy()
+        state["db"] = None
+        return state
+
+    def load(self, readonly=False):
+        """
+        :param readonly: Whether to work on a copy in memory, which leaves
+            the database and the markers as they are
+        """
+        if self.db is not None:
+            self.db.close()
+        # With worker processes the digests are looked up by the thread
+        # feeding the pool, the main thread waits for results meanwhile
+        if readonly:
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+            if os.path.exists(self.filename):
+                _db = sqlite3.connect(self.filename)
+                self.db.executescript("\n".join(_db.iterdump()))
+                _db.close()
+        else:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.executescript(STATE_SCHEMA)
+        self._deployed(readonly)
+        row = self.db.execute(
+            "SELECT id, context FROM run ORDER BY id DESC LIMIT 1").fetchone()
+        if row is None:
+            self.last_run = self.context = None
+        else:
+            self.last_run, self.context = row
+
+    def _deployed(self, readonly=False):
+        """
+        If the powershell script has been run, the state of the run that
+        generated it becomes the deployed one. The script adds the
+        entityIDs of the relying party trusts it failed to add, update or
+        remove to the marker. A trust that failed to be removed stays
+        deployed, so that the next run removes it again. One that failed
+        to be added or updated is deployed with an empty digest, the next
+        run then updates it, or adds it if it isn't there.
+        """
+        try:
+            fp = open(self.deployed_filename, "r")
+        except IOError:
+            return
+        # Add-Content may put a byte order mark in front of what it adds
+        lines = [line.strip().replace("\xef\xbb\xbf", "")
+                 for line in fp.read().splitlines()]
+        fp.close()
+        marker = lines[0] if lines else ""
+        failed = [(line.decode("utf-8"),) for line in lines[1:] if line]
+        last = self.db.execute(
+            "SELECT MAX(id) FROM run WHERE script = 1").fetchone()[0]
+        if marker == str(last):
+            with self.db:
+                self.db.execute("CREATE TEMP TABLE IF NOT EXISTS failed "
+                                "(entity_id TEXT PRIMARY KEY)")
+                self.db.execute("DELETE FROM failed")
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO failed VALUES (?)", failed)
+                self.db.execute(
+                    "UPDATE entity SET deployed_digest = pending_digest, "
+                    "deployed_fields = pending_fields, "
+                    "deployed_fname = pending_fname WHERE entity_id NOT IN "
+                    "(SELECT entity_id FROM failed)")
+                self.db.execute(
+                    "UPDATE entity SET deployed_digest = '', "
+                    "deployed_fields = NULL, deployed_fname = pending_fname "
+                    "WHERE pending_digest IS NOT NULL AND entity_id IN "
+                    "(SELECT entity_id FROM failed)")
+            if failed:
+                print "WARNING: the powershell script failed for %d " \
+                      "relying party trusts, they are retried by this " \
+                      "run" % len(failed)
+        if not readonly:
+            os.unlink(self.deployed_filename)
+
+    def save(self, records, output_files, context):
+        """
+        Records what this run made of every Service Provider, in one
+        transaction.
+
+        :param records: The SPRecords from process_entity, and those of the
+            Service Providers that were skipped or excluded
+        :param output_files: Maps a file name to the metadata and ruleset
+            file names
+        :param context: Digest of what the records depend on besides the
+            metadata
+        """
+        now = time.time()
+        with self.db:
+            self.run = self.db.execute(
+                "INSERT INTO run (started, context) VALUES (?, ?)",
+                (now, context)).lastrowid
+            rows = []
+            for rec in records:
+                certs = " ".join(rec.fingerprints or ())
+                if rec.digest:
+                    metadataFile, rulesetFile = output_files(rec.fname)
+                    rows.append((now, self.run, "exported", rec.digest,
+                                 json.dumps(dict(zip(FIELDS, rec.fields))),
+                                 rec.fname, metadataFile, rulesetFile,
+                                 json.dumps(rec.ruleset_key), rec.source,
+                                 rec.recheck, certs, rec.eid))
+                else:
+                    rows.append((now, self.run, rec.outcome, None, None,
+                                 None, None, None, None, rec.source,
+                                 rec.recheck, certs, rec.eid))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO entity (entity_id, first_seen, "
+                "last_seen, run, outcome) VALUES (?, ?, ?, ?, ?)",
+                [(row[-1], now, now, self.run, row[2]) for row in rows])
+            self.db.executemany(
+                "UPDATE entity SET last_seen = ?, run = ?, outcome = ?, "
+                "digest = ?, fields = ?, fname = ?, metadata_file = ?, "
+                "ruleset_file = ?, ruleset_key = ?, source_digest = ?, "
+                "recheck_after = ?, certs = ? WHERE entity_id = ?", rows)
+
+    def save_pending(self):
+        """
+        Sets the state of this run aside until the powershell script has
+        been run.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE entity SET "
+                "pending_digest = CASE WHEN run = :run THEN digest END, "
+                "pending_fields = CASE WHEN run = :run THEN fields END, "
+                "pending_fname = CASE WHEN run = :run THEN fname END "
+                "WHERE run = :run OR pending_digest IS NOT NULL",
+                {"run": self.run})
+            self.db.execute("UPDATE run SET script = 1 WHERE id = ?",
+                            (self.run,))
+        _tmp = self.pending_filename + ".tmp"
+        fp = open(_tmp, "w")
+        fp.write("%d\n" % self.run)
+        fp.close()
+        if os.path.exists(self.pending_filename):
+            os.unlink(self.pending_filename)
+        os.rename(_tmp, self.pending_filename)
+
+    def discard_pending(self):
+        try:
+            os.unlink(self.pending_filename)
+        except os.error:
+            pass
+
+    def unchanged(self, eid, digest):
+        """
+        Tells if a Service Provider can be skipped: the previous run saw
+        the same metadata, deployed what it made of it and the validity of
+        its certificates hasn't changed since.
+
+        :param eid: The entityID
+        :param digest: The canonical digest of its metadata
+        :return: The SPRecord of the previous run, or None if the entity
+            has to be processed
+        """
+        row = self.db.execute(
+            "SELECT outcome, digest, fields, fname, ruleset_key, "
+            "recheck_after, certs FROM entity WHERE entity_id = ? AND "
+            "source_digest = ? AND run = ? AND digest IS deployed_digest",
+            (eid, digest, self.last_run)).fetchone()
+        if row is None or (row[5] is not None and row[5] <= time.time()):
+            return None
+        outcome, _digest, fields, fname, ruleset_key, recheck, certs = row
+        if outcome == "exported":
+            outcome = None
+        rec = SPRecord(eid, None, outcome)
+        rec.digest = _digest
+        rec.fname = fname
+        if fields is not None:
+            fields = json.loads(fields)
+            rec.fields = tuple([fields[name] for name in FIELDS])
+        if ruleset_key is not None:
+            rules, persistent = json.loads(ruleset_key)
+            rec.ruleset_key = (tuple(rules), persistent)
+        rec.source = digest
+        rec.recheck = recheck
+        rec.fingerprints = tuple(certs.split())
+        return rec
+
+    def digest(self, eid):
+        row = self.db.execute(
+            "SELECT deployed_digest FROM entity WHERE entity_id = ?",
+            (eid,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def fields(self, eid):
+        row = self.db.execute(
+            "SELECT deployed_fields FROM entity WHERE entity_id = ?",
+            (eid,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def deployed(self):
+        """
+        :return: Whether the script of a run has been run through
+        """
+        return self.db.execute("SELECT 1 FROM entity WHERE deployed_digest "
+                               "IS NOT NULL LIMIT 1").fetchone() is not None
+
+    def entity_ids(self):
+        """
+        :return: entityIDs of the deployed relying party trusts
+        """
+        return [row[0] for row in self.db.execute(
+            "SELECT entity_id FROM entity WHERE deployed_digest IS NOT NULL")]
+
+    def removed(self):
+        """
+        :return: entityIDs of the deployed relying party trusts that this
+            run did not export, in order
+        """
+        return [row[0] for row in self.db.execute(
+            "SELECT entity_id FROM entity WHERE deployed_digest IS NOT NULL "
+            "AND (run != ? OR digest IS NULL) ORDER BY entity_id",
+            (self.run,))]
+
+    def summary(self):
+        """
+        :return: number of Service Providers per outcome of this run
+        """
+        return dict(self.db.execute(
+            "SELECT outcome, COUNT(*) FROM entity WHERE run = ? "
+            "GROUP BY outcome", (self.run,)).fetchall())
+
+
+def _der_item(der, pos):
+    """
+    Parses the identifier and length octets of the DER item starting at pos.
+
+    :return: tag, start and end of the content octets
+    """
+    tag = ord(der[pos])
+    length = ord(der[pos + 1])
+    pos += 2
+    if length & 0x80:
+        _len = length & 0x7f
+        length = 0
+        for c in der[pos:pos + _len]:
+            length = (length << 8) | ord(c)
+        pos += _len
+    return tag, pos, pos + length
+
+
+def _der_time(tag, value):
+    if tag == 0x17:  # UTCTime
+        year = int(value[:2])
+        if year < 50:
+            value = "20" + value
+        else:
+            value = "19" + value
+    elif tag != 0x18:  # GeneralizedTime
+        raise ValueError("Not a time value")
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+
+def cert_validity(der):
+    """
+    Picks the notBefore and notAfter times out of a DER encoded X.509
+    certificate without parsing the rest of it.
+
+    :param der: DER encoded certificate
+    :return: notBefore and notAfter as seconds since the epoch
+    """
+    _, pos, _ = _der_item(der, 0)  # Certificate
+    _, pos, _ = _der_item(der, pos)  # TBSCertificate
+    tag, start, end = _der_item(der, pos)
+    if tag == 0xa0:  # version, followed by serialNumber
+        tag, start, end = _der_item(der, end)
+    for _ in range(2):  # signature and issuer
+        tag, start, end = _der_item(der, end)
+    tag, pos, _ = _der_item(der, end)  # validity
+    if tag != 0x30:
+        raise ValueError("Not a validity sequence")
+    validity = []
+    for _ in range(2):
+        tag, start, pos = _der_item(der, pos)
+        validity.append(_der_time(tag, der[start:pos]))
+    return validity
+
+
+class CertCache(object):
+    """
+    Keeps the validity period of certificates, keyed by the SHA-256
+    fingerprint of their DER encoding, so that a certificate is only parsed
+    the first time it is seen. Validity is always evaluated against the
+    current time.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.cert = {}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self._journal = {"cert": {}, "hits": 0, "misses": 0}
+
+    def load(self):
+        # What is seen and counted is per run
+        self.seen = set()
+        self.hits = self.misses = 0
+        try:
+            fp = open(self.filename, "r")
+        except IOError:
+            return
+        try:
+            self.cert = json.load(fp)
+        except ValueError:
+            self.cert = {}
+        fp.close()
+
+    def save(self):
+        """
+        Evicts the certificates that have expired or were not seen since the
+        cache was loaded and writes the rest to disc.
+        """
+        now = time.time()
+        for fpr in self.cert.keys():
+            if fpr not in self.seen or self.cert[fpr][1] < now:
+                del self.cert[fpr]
+        fp = open(self.filename, "w")
+        json.dump(self.cert, fp, sort_keys=True)
+        fp.close()
+
+    def is_active(self, cert):
+        """
+        :param cert: Base64 encoded certificate as found in metadata
+        :return: True if the certificate is valid right now
+        """
+        try:
+            der = base64.b64decode("".join(cert.split()))
+        except TypeError:
+            return False
+        fpr = hashlib.sha256(der).hexdigest()
+        self.seen.add(fpr)
+        try:
+            validity = self.cert[fpr]
+        except KeyError:
+            self.misses += 1
+            self._journal["misses"] += 1
+            try:
+                validity = cert_validity(der)
+            except (IndexError, ValueError):
+                # Leave it to pySAML2, without a validity period to tell
+                # when to check again
+                self._journal["recheck"] = True
+                from saml2.sigver import split_len, active_cert
+                cert = "\n".join(split_len("".join(cert.split()), 64))
+                return active_cert(cert)
+            self.cert[fpr] = validity
+        else:
+            self.hits += 1
+            self._journal["hits"] += 1
+        self._journal["cert"][fpr] = validity
+        return validity[0] <= time.time() <= validity[1]
+
+    def journal(self):
+        """
+        Returns, and starts over, the record of what was looked up since the
+        previous call. Used to carry the work done in worker processes back
+        to the parent.
+        """
+        res = self._journal
+        self._journal = {"cert": {}, "hits": 0, "misses": 0}
+        return res
+
+    def merge(self, journal):
+        self.cert.update(journal["cert"])
+        self.seen.update(journal["cert"].keys())
+        self.hits += journal["hits"]
+        self.misses += journal["misses"]
+
+
+def recheck_after(journal, now):
+    """
+    :param journal: The certificate journal of an entity
+    :return: When the first of the certificates looked up becomes valid or
+        expires, or None if none of them will
+    """
+    if journal.get("recheck"):
+        return now
+    bounds = [bound for validity in journal["cert"].values()
+              for bound in validity if bound > now]
+    if bounds:
+        return min(bounds)
+    return None
+
+
+def canonical_rules(rules):
+    """
+    Normalizes a list of rule names: lower case, without duplicates. The
+    order is kept, ADFS evaluates claim rules in sequence and some rules
+    (like rule_cn.tpl) use claims added by rules before them.
+
+    :param rules: list of rule names
+    :return: tuple of rule names
+    """
+    res = []
+    for r in rules:
+        r = r.strip().lower()
+        if r and r not in res:
+            res.append(r)
+    return tuple(res)
+
+
+def entity_categories(extensions):
+    """
+    Returns the entity categories found in the EntityAttributes extension.
+
+    :param extensions: The extensions of an entity descriptor
+    :return: list of entity category values
+    """
+    res = []
+    for ext_elem in extensions.get("extension_elements", []):
+        if ext_elem["__class__"] == ENTITY_ATTRIBUTES:
+            for attr in ext_elem["attribute"]:
+                if attr["name"] == ENTITY_CATEGORY:
+                    res.extend([val["text"] for val in attr["attribute_value"]])
+            # There is only one EntityAttributes element
+            break
+    return res
+
+
+def registration_authority(entity):
+    """
+    :param entity: Entity descriptor
+    :return: The registrationAuthority of the entity or None
+    """
+    try:
+        ext_elems = entity["extensions"]["extension_elements"]
+    except (KeyError, TypeError):
+        return None
+    for ext_elem in ext_elems:
+        if ext_elem["__class__"] == REGISTRATION_INFO:
+            return ext_elem.get("registration_authority")
+    return None
+
+
+SELECTORS = ["glob", "regex", "registrationAuthority"]
+
+
+def parse_selector(selector):
+    """
+    Splits a selector like "glob:https://*.example.com/*" into kind and
+    pattern. Selectors without a known prefix are exact entityIDs.
+    """
+    selector = selector.strip()
+    kind, _, pattern = selector.partition(":")
+    if kind in SELECTORS:
+        return kind, pattern.strip()
+    return "exact", selector
+
+
+def glob_to_regex(pattern):
+    res = []
+    for c in pattern:
+        if c == "*":
+            res.append(".*")
+        elif c == "?":
+            res.append(".")
+        else:
+            res.append(re.escape(c))
+    return "".join(res) + r"\Z"
+
+
+def _group_references(node):
+    """
+    Whether a parsed regular expression refers to one of its groups
+    """
+    if isinstance(node, sre_parse.SubPattern):
+        node = node.data
+    if isinstance(node, (list, tuple)):
+        if node and node[0] in (sre_parse.GROUPREF,
+                                sre_parse.GROUPREF_EXISTS):
+            return True
+        for item in node:
+            if _group_references(item):
+                return True
+    return False
+
+
+class EntityMatcher(object):
+    """
+    Matches entities against a list of selectors: exact entityIDs, globs
+    ("glob:https://*.example.com/*"), regular expressions
+    ("regex:^https://sp[0-9]+\.example\.com/") and registration authorities
+    ("registrationAuthority:http://www.swamid.se/").
+
+    The selectors are compiled into a set of exact entityIDs, a prefix trie
+    for globs that only have a trailing "*", one alternation regular
+    expression for the other globs and regular expressions, and a set of
+    registration authorities, so the cost of a match hardly depends on the
+    number of selectors. When several selectors match, the one added first
+    wins. Regular expressions that can't be combined with others, as they
+    refer to their own groups or set flags, are matched on their own.
+    """
+    # The re module of Python 2 supports at most 100 groups per pattern,
+    # counting the whole match as one
+    group_limit = 99
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.authority = {}
+        self.patterns = []
+        self.standalone = []
+        self.regex = []
+        self.value = []
+
+    def __len__(self):
+        return len(self.value)
+
+    def add(self, selector, value=True):
+        kind, pattern = parse_selector(selector)
+        order = len(self.value)
+        self.value.append(value)
+        if kind == "exact":
+            self.exact.setdefault(pattern, order)
+        elif kind == "registrationAuthority":
+            self.authority.setdefault(pattern, order)
+        elif kind == "glob" and pattern.endswith("*") and not [
+                c for c in pattern[:-1] if c in "*?"]:
+            node = self.trie
+            for c in pattern[:-1]:
+                node = node.setdefault(c, {})
+            node.setdefault(None, order)
+        elif kind == "glob":
+            self._add_pattern(selector, glob_to_regex(pattern), order)
+        else:
+            self._add_pattern(selector, pattern, order)
+
+    def _add_pattern(self, selector, pattern, order):
+        try:
+            regex = re.compile(pattern)
+        except re.error, e:
+            raise ValueError("invalid selector %s: %s" % (selector, e))
+        if (regex.flags or regex.groupindex or
+                regex.groups + 1 > self.group_limit or
+                _group_references(sre_parse.parse(pattern))):
+            self.standalone.append((regex, order, None))
+        else:
+            self.patterns.append((pattern, regex.groups, order))
+
+    def compile(self):
+        """
+        Combines the regular expressions into alternations, as many at a
+        time as the limit on the number of groups allows. Every expression
+        is put in a group of its own, which tells which of them matched.
+        """
+        self.regex = list(self.standalone)
+        chunk = []
+        groups = 0
+        for pattern, _groups, order in self.patterns:
+            if chunk and groups + _groups + 1 > self.group_limit:
+                self._compile_chunk(chunk)
+                chunk = []
+                groups = 0
+            chunk.append((pattern, _groups, order))
+            groups += _groups + 1
+        if chunk:
+            self._compile_chunk(chunk)
+        self.regex.sort(key=lambda item: item[1])
+
+    def _compile_chunk(self, chunk):
+        # The number of the group around each expression
+        orders = {}
+        index = 1
+        for pattern, groups, order in chunk:
+            orders[index] = order
+            index += groups + 1
+        self.regex.append((re.compile("|".join(
+            ["(%s)" % pattern for pattern, _, _ in chunk])), chunk[0][2],
+            orders))
+
+    def _order(self, entityID, authority, first=False):
+        orders = []
+        try:
+            orders.append(self.exact[entityID])
+        except KeyError:
+            pass
+        if authority is not None:
+            try:
+                orders.append(self.authority[authority])
+            except KeyError:
+                pass
+        node = self.trie
+        for c in entityID:
+            if None in node:
+                orders.append(node[None])
+            try:
+                node = node[c]
+            except KeyError:
+                node = None
+                break
+        if node and None in node:
+            orders.append(node[None])
+        if orders and first:
+            return orders[0]
+        for regex, first_order, _orders in self.regex:
+            # an expression can't beat a match that was added before it
+            if orders and (first or min(orders) < first_order):
+                break
+            _match = regex.match(entityID)
+            if _match:
+                if _orders is None:
+                    orders.append(first_order)
+                else:
+                    # The group of the expression closes after those in it
+                    orders.append(_orders[_match.lastindex])
+        if orders:
+            return min(orders)
+        return None
+
+    def match(self, entityID, authority=None):
+        """
+        :param entityID: The entityID
+        :param authority: The registrationAuthority of the entity, if any
+        :return: The value of the first selector that matches or None
+        """
+        order = self._order(entityID, authority)
+        if order is None:
+            return None
+        return self.value[order]
+
+    def matches(self, entityID, authority=None):
+        """
+        Like match but only tells if any selector matches, which allows
+        stopping at the first hit.
+        """
+        return self._order(entityID, authority, True) is not None
+
+
+class TemplateRegistry(object):
+    """
+    Reads and compiles all the templates in a set of directories once.
+    Templates in later directories override those with the same name in
+    earlier ones.
+    """
+    def __init__(self, directories):
+        self.template = {}
+        _hash = hashlib.sha256()
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for fname in sorted(os.listdir(directory)):
+                if fname.endswith(".tpl"):
+                    fp = open(pjoin(directory, fname), "r")
+                    text = fp.read()
+                    fp.close()
+                    self.template[fname[:-4]] = Template(text)
+                    _hash.update("%s\0%s\0" % (fname, text))
+        self.digest = _hash.hexdigest()
+
+    def __getitem__(self, name):
+        return self.template[name]
+
+    def __contains__(self, name):
+        return name in self.template
+
+
+_WORKER_FEMMA = None
+
+
+def _init_worker(femma):
+    global _WORKER_FEMMA
+    _WORKER_FEMMA = femma
+    # Sync what is left of the last batch when the worker exits
+    multiprocessing.util.Finalize(None, femma.output.sync, exitpriority=10)
+
+
+def _process_entity(task):
+    return _WORKER_FEMMA.run_task(task)
 
 
 class Femma(object):
@@ -111,21 +1922,58 @@ class Femma(object):
         self.fed_name_prefix = ""
         self.my_proxy = ""
         self.ps1_filename = ""
-        self.ruleset_transient = ""
-        self.ruleset_persistent = ""
-        self.powershell_base = ""
-        self.powershell_metadata_update = ""
+        self.output_dir = ""
+        self.output = None
+        self.templates = None
+        self._rule_cache = {}
+        self._category_index = {}
+        self.excluded = EntityMatcher()
+        self.sp_attributes = {}
+        self.sp_attribute_patterns = EntityMatcher()
+        self.sensitive_rules = frozenset()
+        self.cache_dir = ""
+        self.state = None
+        self.cert_cache = None
+        self.signature_cache = None
+        self.check_xml = False
+        self.plan = False
+        self.profiler = Profiler(enabled=False)
         self.config = None
 
+    def __getstate__(self):
+        # The metadata store stays with the parent process, worker processes
+        # are handed one entity at a time.
+        state = self.__dict__.copy()
+        state["mds"] = None
+        return state
+
     def setup(self):
+        # Also run again by the daemon when the settings or templates change,
+        # nothing derived from the old ones may be kept
+        self._rule_cache = {}
+        self.policy = None
+        self.output_dir = os.path.abspath(self.output_dir or os.getcwd())
         for name, filename in DIR.items():
-            setattr(self, name + "_dir", pjoin(os.getcwd(), filename))
-        for template in TPL:
-            setattr(self, template, pjoin(self.template_dir, template + ".tpl"))
+            if name in OUTPUT_DIR:
+                setattr(self, name + "_dir", pjoin(self.output_dir, filename))
+            else:
+                setattr(self, name + "_dir", pjoin(os.getcwd(), filename))
         self.rule_prefix = "rule_"
-        self.rules_dir = self.template_dir
         self.custom_rules_dir = pjoin(self.template_dir, "customRules")
-        self.ps1_filename = pjoin(os.getcwd(), "update_adfs_rptrust.ps1")
+        self.templates = TemplateRegistry([self.template_dir,
+                                           self.custom_rules_dir])
+        for template in TPL:
+            if template not in self.templates:
+                print "ERROR: template %s.tpl not found" % template
+                sys.exit(1)
+        self.ps1_filename = pjoin(self.output_dir, PS1_FILE)
+        self.output = OutputWriter(self.output_dir,
+                                   [DIR[name] for name in OUTPUT_DIR],
+                                   PS1_FILE)
+        self.state = StateStore(pjoin(self.cache_dir, STATE_FILE))
+        self.cert_cache = CertCache(pjoin(self.cache_dir, CERT_CACHE_FILE))
+        self.signature_cache = SignatureCache(pjoin(self.cache_dir,
+                                                    SIGNATURE_CACHE_FILE))
         
         if os.path.exists(self.settings_file):
             self.config = ConfigParser.ConfigParser()
@@ -146,25 +1994,30 @@ class Femma(object):
             except ConfigParser.NoOptionError:
                 pass
             else:
+                from saml2.assertion import Policy
                 self.policy = Policy({"default": {
                     "entity_categories": ent_cats}})
-
-            if not (os.path.exists(self.metadata_dir) and 
-                    os.path.isdir(self.metadata_dir)):
-                os.mkdir(self.metadata_dir)
-            if not (os.path.exists(self.ruleset_dir) and 
-                    os.path.isdir(self.ruleset_dir)):
-                os.mkdir(self.ruleset_dir)
+            self._category_index = {}
+            self._build_config_index()
+
+            if not (os.path.exists(self.output_dir) and
+                    os.path.isdir(self.output_dir)):
+                os.makedirs(self.output_dir)
+            if not (os.path.exists(self.cache_dir) and
+                    os.path.isdir(self.cache_dir)):
+                os.mkdir(self.cache_dir)
         else:
             print "ERROR: FEMMA configuration files not found"
             sys.exit(1)
     
     def clean_up(self):
         """
-        Cleans up temporary folders
+        Cleans up temporary folders. The cache folder, holding the state
+        of the previous run, is left alone.
         """
         shutil.rmtree(self.metadata_dir, True)
         shutil.rmtree(self.ruleset_dir, True)
+        self.output.clean_up()
 
         try:
             os.unlink(self.ps1_filename)
@@ -173,7 +2026,42 @@ class Femma(object):
 
         sys.exit(0)
 
-    def entity_to_ignore(self,entityID):
+    def _build_config_index(self):
+        """
+        Compiles the exclusion list, the per Service Provider rules and the
+        sensitive rules of the settings into lookup tables, so that the
+        checks per entity don't have to go through ConfigParser.
+        """
+        self.excluded = EntityMatcher()
+        try:
+            for _, val in self.config.items('ExcludeEntityID', True):
+                self.excluded.add(val)
+        except ConfigParser.NoSectionError:
+            pass
+        self.excluded.compile()
+        try:
+            self.sp_attributes = dict(
+                [(key, canonical_rules(val.split(','))) for key, val in
+                 self.config.items('ServiceProviderAttributes', True)])
+        except ConfigParser.NoSectionError:
+            self.sp_attributes = {}
+        self.sp_attribute_patterns = EntityMatcher()
+        try:
+            for _, val in self.config.items('ServiceProviderAttributePatterns',
+                                            True):
+                selector, _, rules = val.rpartition("|")
+                self.sp_attribute_patterns.add(
+                    selector, canonical_rules(rules.split(',')))
+        except ConfigParser.NoSectionError:
+            pass
+        self.sp_attribute_patterns.compile()
+        try:
+            self.sensitive_rules = frozenset(canonical_rules(
+                self.config.get('SensitiveAttributes', 'rules').split(',')))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.sensitive_rules = frozenset()
+
+    def entity_to_ignore(self, entityID, entity=None):
         """
         Checks if the provided entityID of the Service Provider is blacklisted
         To blacklist an entity ID insert a section into the settings file, with
@@ -181,17 +2069,22 @@ class Femma(object):
         [ExcludeEntityID]
         entity1 = "https://my.example.com/service"
         entity2 = "https://anotherexample.net/service2"
-        """
 
-        try:
-            toIgnore = self.config.items('ExcludeEntityID')
-        except ConfigParser.NoSectionError:
-            return False
+        Whole groups of entities can be excluded using glob patterns, regular
+        expressions or the registration authority:
+        entity3 = glob:https://*.example.org/*
+        entity4 = regex:^https://sp[0-9]+\.example\.net/
+        entity5 = registrationAuthority:http://www.example.org/
 
-        if entityID in [x[1] for x in toIgnore]:
-            return True
+        :param entityID: The entityID
+        :param entity: Entity descriptor, needed to match on the registration
+            authority
+        """
+        if entity is None:
+            authority = None
         else:
-            return False
+            authority = registration_authority(entity)
+        return self.excluded.matches(entityID, authority)
 
     def _strip_protocol_identifier(self, eid):
         if eid.startswith("http"):
@@ -199,7 +2092,32 @@ class Femma(object):
         else:
             return eid
 
-    def is_persistent(self, entityID):
+    def _configured_rules(self, entityID, entity=None):
+        """
+        Exact entries in the ServiceProviderAttributes section take
+        precedence over the selectors in the ServiceProviderAttributePatterns
+        section, which are tried in order:
+        [ServiceProviderAttributePatterns]
+        example = glob:https://*.example.org/* | eppn,mail
+        swamid = registrationAuthority:http://www.swamid.se/ | eppn
+
+        :return: The rules configured for the entityID or None
+        """
+        entityName = self._strip_protocol_identifier(entityID)
+        # option names are normalized by ConfigParser, by default lower case
+        try:
+            return self.sp_attributes[self.config.optionxform(entityName)]
+        except KeyError:
+            pass
+        if not self.sp_attribute_patterns:
+            return None
+        if entity is None:
+            authority = None
+        else:
+            authority = registration_authority(entity)
+        return self.sp_attribute_patterns.match(entityID, authority)
+
+    def is_persistent(self, entityID, entity=None):
         """
         Checks if the provided entityID of the Service Provider has configured rules
         that match a list of sensitive ones. If this is the case, it associates a
@@ -213,68 +2131,66 @@ class Femma(object):
         To force the persistent NameID format, specify "persistent" in the SP
         attribute list
         """
-        ret = False
-
-        entityName = self._strip_protocol_identifier(entityID)
+        configuredRules = self._configured_rules(entityID, entity)
+        if not configuredRules:
+            return False
+        return not self.sensitive_rules.isdisjoint(configuredRules)
 
+    def _category_attributes(self, category):
+        """
+        The attributes the policy releases for an entity category, asked
+        once per category so that the policy is not consulted per entity.
+        """
         try:
-            sensitiveRules = self.config.get('SensitiveAttributes', 'rules')
-            configuredRules = self.config.get('ServiceProviderAttributes',
-                                              entityName)
-            for r in sensitiveRules.split(','):
-                if r in configuredRules.split(','):
-                    ret = True
-                    break
-        except Exception, e:
+            return self._category_index[category]
+        except KeyError:
             pass
-
-        return ret
+        if self.policy:
+            attrs = canonical_rules(
+                self.policy.entity_category_attributes(category) or [])
+        else:
+            attrs = ()
+        self._category_index[category] = attrs
+        return attrs
 
     def _entity_category_attributes(self, entity, extensions):
         attrs = []
-        try:
-            ext_elem = extensions["extension_elements"]
-        except KeyError:
-            pass
-        else:
-            for ext_elem in ext_elem:
-                if ext_elem["__class__"] == ENTITY_ATTRIBUTES:
-                    for attr in ext_elem["attribute"]:
-                        if attr["name"] == ENTITY_CATEGORY:
-                            for val in attr["attribute_value"]:
-                                attrs.extend(
-                                    self.policy.entity_category_attributes(
-                                        val["text"]))
+        for category in entity_categories(extensions):
+            attrs.extend(self._category_attributes(category))
         if attrs:
-            attrs.extend(self.policy.entity_category_attributes(""))
-            # get rid of duplicates
-            list(set(attrs))
+            attrs.extend(self._category_attributes(""))
 
-        return attrs
+        # get rid of duplicates
+        return canonical_rules(attrs)
 
     def _rules(self, rules):
+        # Rendered rule blocks are remembered per attribute list
+        _key = tuple(rules)
+        try:
+            return self._rule_cache[_key]
+        except KeyError:
+            pass
+
         ret = ""
         for r in rules:
             r = r.lower()
-            ruleFileName = self.rule_prefix + r + '.tpl'
-            if os.path.exists(self.rules_dir + os.sep + ruleFileName):
-                ruleFile = open(self.rules_dir + os.sep + ruleFileName, 'r')
-                ret += ruleFile.read()
-                ruleFile.close()
+            ruleName = self.rule_prefix + r
+            if ruleName in self.templates:
+                ret += self.templates[ruleName].template
             else:
                 names = self.config.get('Attributes', r).split(",")
                 try:
                     attribute_name, name = names
                 except ValueError:
                     attribute_name = name = names[0]
-                fname = pjoin(self.rules_dir, self.rule_prefix + '.tpl')
-                ruleTPL = Template(open(fname, "r").read())
+                ruleTPL = self.templates[self.rule_prefix]
                 rule_set = ruleTPL.substitute(attribute=attribute_name,
                                               name=name)
                 ret += rule_set
+        self._rule_cache[_key] = ret
         return ret
 
-    def get_rules(self, entity):
+    def rule_names(self, entity):
         """
         Checks if the provided entityID of the Service Provider needs additional
         rules other than the default ones.
@@ -291,55 +2207,60 @@ class Femma(object):
         found for a entity_id.
 
         :param entity: Entity Descriptor
-        :return: rules
+        :return: tuple of rule names
         """
-        ret = ""
-
-        entityName = self._strip_protocol_identifier(entity["entity_id"])
-
-        try:
-            rules = self.config.get('ServiceProviderAttributes', entityName)
-        except ConfigParser.NoSectionError:
+        rules = self._configured_rules(entity["entity_id"], entity)
+        if rules is None:
             try:
                 extensions = entity["extensions"]
             except KeyError:
-                pass
+                rules = ()
             else:
-                ret = self._rules(
-                    self._entity_category_attributes(entity, extensions))
-        else:
-            ret = self._rules(rules.split(','))
+                rules = self._entity_category_attributes(entity, extensions)
 
-        if not ret and self.policy:
-            ret = self._rules(self.policy.entity_category_attributes(""))
+        if not rules and self.policy:
+            rules = self._category_attributes("")
 
-        return ret
+        return rules
+
+    def ruleset_key(self, entity):
+        """
+        Canonical description of the ruleset of a Service Provider, the rule
+        names and whether a persistent NameID is used. Service Providers with
+        the same key share the body of their rulesets.
+
+        :param entity: Entity Descriptor
+        :return: tuple of rule names and persistent flag
+        """
+        return (self.rule_names(entity),
+                self.is_persistent(entity["entity_id"], entity))
 
-    def ruleset_creation(self, myClaimType, rulesetFileName, entity):
+    def ruleset(self, myClaimType, entity, key=None):
         """
-        Creates Service Provider ruleset file with NameID creation based on
-        persistent-id by default
+        Returns the ruleset for a Service Provider, the NameID creation rules
+        followed by the attribute rules.
         """
         _eid = entity["entity_id"]
+        if key is None:
+            key = self.ruleset_key(entity)
+        rules, persistent = key
+        # load template from configured file
+        if persistent:
+            ruleID = self.templates["ruleset_persistent"]
+        else:
+            ruleID = self.templates["ruleset_transient"]
+
+        # susbstitutes rules and entityID
+        outRuleset = ruleID.substitute(claimBaseType=myClaimType,
+                                       spNameQualifier=_eid,
+                                       nameQualifier=self.idp_entity_id)
         try:
-            # load template from configured file
-            if self.is_persistent(_eid):
-                ruleID = Template(open(self.ruleset_persistent, "r").read())
-            else:
-                ruleID = Template(open(self.ruleset_transient, "r").read())
-
-            # susbstitutes rules and entityID
-            outRuleset = ruleID.substitute(claimBaseType=myClaimType,
-                                           spNameQualifier=_eid,
-                                           nameQualifier=self.idp_entity_id)
-            # create ruleset files
-            rulesetFile = open(rulesetFileName, "w")
-            rulesetFile.write(outRuleset)
-            rulesetFile.write(self.get_rules(entity))
-            rulesetFile.close()
-        except Exception, e:
-            print(e)
-        return
+            outRuleset += self._rules(rules)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError), e:
+            # A rule without template or attribute, no attributes are
+            # released
+            print "WARNING: no attribute rules for %s (%s)" % (_eid, e)
+        return outRuleset
 
     def stripBindingsNotSupported(self, entity):
         """
@@ -416,17 +2337,15 @@ class Femma(object):
                         for kn in key_name:
                             if kn["text"] == "Standby":
                                 toRemove.append(kd)
+                                stand_by = True
                                 break
                         if stand_by:
-                            break
+                            continue
                     x509_data = kd["key_info"]["x509_data"]
                     cert_to_remove = []
                     for x in x509_data:
                         xc = x["x509_certificate"]
-                        cert = xc["text"].strip()
-                        cert = "\n".join(split_len("".join([s.strip() for s in
-                                                            cert.split()]), 64))
-                        if not active_cert(cert):
+                        if not self.cert_cache.is_active(xc["text"]):
                             cert_to_remove.append(x)
                     for c in cert_to_remove:
                         x509_data.remove(c)
@@ -446,7 +2365,297 @@ class Femma(object):
             entity["spsso_descriptor"] = _sps
             return entity
 
-    def extract(self):
+    def stripRolloverKeysElement(self, elem):
+        """
+        Same as stripRolloverKeys but works in place on the EntityDescriptor
+        element.
+
+        :param elem: EntityDescriptor element
+        :return: The element or None of no working keys remain
+        """
+        _sps = []
+        for sp in elem.findall(MD_SPSSO):
+            toRemove = []
+            for kd in sp.findall(MD_KEY_DESCRIPTOR):
+                key_info = kd.find(DS_KEY_INFO)
+                if key_info is None:
+                    toRemove.append(kd)
+                    continue
+                if [kn for kn in key_info.findall(DS_KEY_NAME)
+                        if kn.text == "Standby"]:
+                    toRemove.append(kd)
+                    continue
+                for x in key_info.findall(DS_X509_DATA):
+                    xc = x.find(DS_X509_CERTIFICATE)
+                    if xc is None or not self.cert_cache.is_active(
+                            xc.text or ""):
+                        key_info.remove(x)
+                if key_info.find(DS_X509_DATA) is None:
+                    toRemove.append(kd)
+
+            for j in toRemove:
+                sp.remove(j)
+                print ("WARNING: removed KeyName element")
+
+            if sp.find(MD_KEY_DESCRIPTOR) is not None:
+                _sps.append(sp)
+            else:
+                elem.remove(sp)
+
+        if not _sps:
+            return None
+        else:
+            return elem
+
+    def stripBindingsNotSupportedElement(self, elem):
+        """
+        Same as stripBindingsNotSupported but works in place on the
+        EntityDescriptor element.
+
+        :param elem: EntityDescriptor element
+        :return: The element or None of no usable endpoints remained
+        """
+        _sps = []
+        for sp in elem.findall(MD_SPSSO):
+            _acs = []
+            for acs in sp.findall(MD_ACS):
+                if acs.get("Binding") not in BINDINGS_NOT_SUPPORTED:
+                    if acs.get("Location", "").startswith("https:"):
+                        _acs.append(acs)
+                        continue
+                sp.remove(acs)
+            for sls in sp.findall(MD_SLS):
+                if sls.get("Binding") in BINDINGS_NOT_SUPPORTED:
+                    print "Removed not supported binding: %s" % sls.get(
+                        "Binding")
+                    sp.remove(sls)
+                elif not sls.get("Location", "").startswith("https:"):
+                    print "Removed endpoint since not HTTPS"
+                    sp.remove(sls)
+
+            if not _acs:
+                elem.remove(sp)
+            else:
+                _sps.append(sp)
+
+        if not _sps:
+            return None
+        else:
+            return elem
+
+    def file_name(self, eid):
+        """
+        Maps an entityID to a name usable as a file name
+        """
+        fname = eid.replace('/', '_').replace('.', '_').replace(':', '_')
+        return "".join([x for x in fname
+                        if x.isalpha() or x.isdigit() or x == '-' or x == '_'])
+
+    def output_files(self, fname):
+        """
+        :return: The metadata and ruleset file names for a file name from
+            file_name
+        """
+        return (pjoin(self.metadata_dir, fname + ".xml"),
+                pjoin(self.ruleset_dir, fname))
+
+    def context(self, raw=None):
+        """
+        Digest of what the outcome for a Service Provider depends on besides
+        its metadata: the settings, the templates, the output directory and
+        whether the metadata is handled as XML elements.
+
+        :param raw: Whether the metadata will be handled as XML elements,
+            used as long as there is no metadata store
+        """
+        fp = open(self.settings_file, "rb")
+        _hash = hashlib.sha256(fp.read())
+        fp.close()
+        _hash.update(self.templates.digest)
+        _hash.update(self.output_dir)
+        if self.mds is not None:
+            raw = getattr(self.mds, "raw", None)
+        _hash.update(repr(raw))
+        return _hash.hexdigest()
+
+    def _tasks(self, incremental, excluded):
+        for eid, entity in self.profiler.iterate("parse", self.mds.items()):
+            if "spsso_descriptor" in entity or "xml" in entity:
+                if self.entity_to_ignore(eid, entity):
+                    excluded.append(SPRecord(eid, None, "excluded"))
+                else:
+                    if incremental:
+                        yield eid, entity, self.state.digest(eid)
+                    else:
+                        yield eid, entity, None
+
+    def run_task(self, task):
+        """
+        Runs process_entity on a task from _tasks, with the time spent
+        recorded in the result when profiling.
+        """
+        self.profiler.start_entity(task[0])
+        res = self.process_entity(*task)
+        res.profile = self.profiler.end_entity()
+        return res
+
+    def process_entity(self, eid, entity, previous=None):
+        """
+        Filters the metadata of one Service Provider and writes its metadata
+        and ruleset files.
+
+        :param eid: The entityID
+        :param entity: Entity descriptor, either the dictionary form or, as
+            handed out by a raw MetadataStream, the serialized element
+        :param previous: Digest from the previous run, if it matches the
+            files are not written
+        :return: A SPRecord describing the outcome, the digest is None if
+            the entity was weeded out
+        """
+        print "---- %s ----" % eid
+        if "xml" in entity:
+            return self.process_element(eid, entity, previous)
+
+        with self.profiler.phase("strip_keys"):
+            entity = self.stripRolloverKeys(entity)
+        journal = self.cert_cache.journal()
+        if not entity:
+            print "No working keys for %s" % eid
+            return SPRecord(eid, journal, "No working keys")
+        with self.profiler.phase("strip_bindings"):
+            entity = self.stripBindingsNotSupported(entity)
+        if not entity:
+            print "No working endpoints for %s" % eid
+            return SPRecord(eid, journal, "No working endpoints")
+
+        from saml2.mdie import from_dict
+
+        return self._write_entity(eid, entity, entity,
+                                  lambda: "%s" % from_dict(entity, onts()),
+                                  entity_fields(entity), journal, previous)
+
+    def process_element(self, eid, entity, previous=None):
+        """
+        Filters the EntityDescriptor element in place and writes it out as
+        is, skipping the conversion to pySAML2 objects and back.
+        """
+        with self.profiler.phase("strip_keys"):
+            elem = self.stripRolloverKeysElement(
+                etree.fromstring(entity["xml"]))
+        journal = self.cert_cache.journal()
+        if elem is None:
+            print "No working keys for %s" % eid
+            return SPRecord(eid, journal, "No working keys")
+        with self.profiler.phase("strip_bindings"):
+            elem = self.stripBindingsNotSupportedElement(elem)
+        if elem is None:
+            print "No working endpoints for %s" % eid
+            return SPRecord(eid, journal, "No working endpoints")
+
+        with self.profiler.phase("serialize"):
+            xml = etree.tostring(elem, xml_declaration=True, encoding="UTF-8")
+        if self.check_xml:
+            self.check_serialization(eid, entity["xml"], xml)
+        return self._write_entity(eid, entity, xml, lambda: xml,
+                                  element_fields(elem), journal, previous)
+
+    def check_serialization(self, eid, original, xml):
+        """
+        Runs the original EntityDescriptor through the dictionary based
+        filters and serialization and reports if the result differs from
+        what the element based path produced.
+        """
+        from saml2 import md
+        from saml2.mdie import from_dict
+        from saml2.mdstore import to_dict
+
+        entity = to_dict(md.entity_descriptor_from_string(original),
+                         onts().values())
+        # The certificates are looked up a second time, that must neither
+        # count nor end up in the journal of the next entity
+        hits, misses = self.cert_cache.hits, self.cert_cache.misses
+        entity = self.stripRolloverKeys(entity)
+        self.cert_cache.journal()
+        self.cert_cache.hits, self.cert_cache.misses = hits, misses
+        if entity:
+            entity = self.stripBindingsNotSupported(entity)
+        if not entity:
+            print "WARNING: %s would have been weeded out" % eid
+        elif not xml_equivalent("%s" % from_dict(entity, onts()), xml):
+            print "WARNING: serializations of %s differ" % eid
+
+    def _write_entity(self, eid, entity, content, metadata, fields, journal,
+                      previous):
+        fname = self.file_name(eid)
+        with self.profiler.phase("ruleset"):
+            ruleset_key = self.ruleset_key(entity)
+            ruleset = self.ruleset(self.my_claim_type, entity, ruleset_key)
+        with self.profiler.phase("digest"):
+            digest = entity_digest(content, ruleset)
+            fields = field_digests(fields, ruleset)
+        res = SPRecord(eid, journal)
+        res.fname = fname
+        res.digest = digest
+        res.fields = fields
+        res.ruleset_key = ruleset_key
+        if previous == digest:
+            print "Unchanged %s" % eid
+            return res
+        if self.plan:
+            return res
+
+        print " ".join(["Generating XML metadata for", eid])
+        with self.profiler.phase("serialize"):
+            text = metadata()
+        entityFileName, rulesetFileName = self.output_files(fname)
+        with self.profiler.phase("write"):
+            self.output.write(entityFileName, text)
+            self.output.write(rulesetFileName, ruleset)
+        res.written = True
+        return res
+
+    def print_plan(self, results):
+        """
+        Prints which Service Providers would be added, updated and removed
+        compared with those deployed by the previous run, with the parts
+        that changed according to the digests kept in the state.
+
+        :param results: The SPRecords from process_entity
+        """
+        current = dict([(r.eid, r) for r in results if r.digest])
+        outcome = dict([(r.eid, r.outcome) for r in results if not r.digest])
+        added = []
+        updated = []
+        for eid in sorted(current):
+            previous = self.state.digest(eid)
+            if previous is None:
+                added.append(eid)
+            elif previous != current[eid].digest:
+                fields = self.state.fields(eid)
+                if fields is None:
+                    reasons = ["changed, the previous run kept no details"]
+                else:
+                    reasons = [reason for (name, reason), digest in zip(
+                        PLAN_REASONS, current[eid].fields)
+                        if fields.get(name) != digest]
+                updated.append((eid, reasons or ["metadata changed"]))
+        removed = sorted([eid for eid in self.state.entity_ids()
+                          if eid not in current])
+
+        print "Plan: %d to add, %d to update, %d to remove, %d unchanged" % (
+            len(added), len(updated), len(removed),
+            len(current) - len(added) - len(updated))
+        for eid in added:
+            print "+ %s" % eid
+        for eid, reasons in updated:
+            print "~ %s: %s" % (eid, ", ".join(reasons))
+        for eid in removed:
+            print "- %s: %s" % (eid, outcome.get(eid, "not in the metadata"))
+        if os.path.exists(self.state.pending_filename):
+            print "WARNING: the powershell script of the previous run has " \
+                  "not been run, the plan is relative to the run before"
+
+    def extract(self, incremental=False, workers=1, plan=False):
         """
         Creates separate metadata file for each Service Provider entityID in
         the original metadata files.
@@ -456,92 +2665,475 @@ class Femma(object):
         2. no Assertion Consuming Services endpoints with bindings supported by
             ADFS
         3. no HTTPS based Assertion Consuming Service endpoints
-        """
-        pshScript = ""
-        pshScriptTemplate = Template(open(self.powershell_metadata_update,
-                                          'r').read())
-
-        # for EntityDescriptor extracts SP and write a single metadata file
-        for eid, entity in self.mds.items():
-            if "spsso_descriptor" in entity:
-                if not self.entity_to_ignore(eid):
-                    print "---- %s ----" % eid
-                    entity = self.stripRolloverKeys(entity)
-                    if not entity:
-                        print "No working keys for %s" % eid
-                        continue
-                    entity = self.stripBindingsNotSupported(entity)
-                    if not entity:
-                        print "No working endpoints for %s" % eid
-                        continue
 
-                    fname = eid.replace('/', '_').replace('.', '_').replace(
-                        ':', '_')
-                    fname = "".join(
-                        [x for x in fname
-                         if x.isalpha() or x.isdigit() or x == '-' or x == '_'])
-
-                    print " ".join(["Generating XML metadata for", eid])
-                    entityFileName = pjoin(self.metadata_dir,
-                                           fname + ".xml")
-                    entityFile = open(entityFileName, "w")
-                    entityFile.write("%s" % from_dict(entity, ONTS))
-                    entityFile.close()
-                    rulesetFileName = pjoin(self.ruleset_dir, fname)
-                    self.ruleset_creation(self.my_claim_type,
-                                          rulesetFileName, entity)
-                    pshScript += pshScriptTemplate.substitute(
-                        fedName=self.fed_name_prefix,
-                        metadataFile=entityFileName,
-                        rpName=eid,
-                        rulesetFile=rulesetFileName)
+        In incremental mode the result is compared with the Service
+        Providers deployed by the previous run. Only new and changed Service
+        Providers get metadata and ruleset files, and the powershell script
+        adds the new relying party trusts, updates the changed ones in place
+        and removes those that disappeared, instead of recreating all of them.
 
-        if pshScript:
+        With more than one worker the per entity work is spread over a pool
+        of processes.
+
+        The files are written to a staging directory and only replace those
+        of the previous run once everything has been generated.
+
+        As a plan nothing is written, what would change compared with the
+        Service Providers deployed by the previous run is printed instead.
+
+        :param incremental: Whether to only handle changed entities
+        :param workers: Number of worker processes
+        :param plan: Whether to only report what would change
+        """
+        pshScript = ""
+        self.state.load(readonly=plan)
+        if incremental and not plan and not self.state.deployed():
+            # The relying party trusts may have been created by a full run,
+            # those of Service Providers that have left the metadata since
+            # would never be removed
+            print "No deployed state yet, all relying party trusts are " \
+                  "recreated"
+            incremental = False
+        if incremental:
+            pshAddTemplate = self.templates["powershell_add"]
+            pshUpdateTemplate = self.templates["powershell_update"]
+        else:
+            pshAddTemplate = self.templates["powershell_metadata_update"]
+        self.cert_cache.load()
+        self.plan = plan
+        if not plan:
+            self.output.start()
+        context = self.context()
+        # Only new and changed Service Providers need to be looked at when
+        # the metadata can be split and the settings are those of the
+        # previous run
+        if ((incremental or plan) and isinstance(self.mds, MetadataStream)
+                and context == self.state.context):
+            self.mds.unchanged = self.state.unchanged
+        excluded = []
+        added = []
+        changed = []
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+            records = pool.imap_unordered(
+                _process_entity, self._tasks(incremental or plan, excluded),
+                16)
+        else:
+            pool = None
+            records = (self.run_task(task) for task in
+                       self._tasks(incremental or plan, excluded))
+
+        # Only the compact part of the records is kept for the whole run
+        now = time.time()
+        results = []
+        for res in records:
+            self.profiler.add_entity(res.profile)
+            if pool is not None:
+                self.cert_cache.merge(res.certs)
+            res.recheck = recheck_after(res.certs, now)
+            res.fingerprints = tuple(sorted(res.certs["cert"]))
+            res.certs = res.profile = None
+            results.append(res)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        skipped = getattr(self.mds, "skipped", [])
+        if skipped:
+            print "%d Service Providers unchanged since the previous run " \
+                  "were skipped" % len(skipped)
+        for res in skipped:
+            # Still in use, or they would be evicted from the cache
+            self.cert_cache.seen.update(res.fingerprints)
+        results.extend(skipped)
+        results.extend(excluded)
+        digests = getattr(self.mds, "digests", {})
+        for res in results:
+            res.source = digests.get(res.eid)
+
+        if plan:
+            self.print_plan(results)
+            return
+        self.cert_cache.save()
+        print "Certificate cache: %d hits, %d misses" % (self.cert_cache.hits,
+                                                        self.cert_cache.misses)
+        self.state.save(results, self.output_files, context)
+
+        # The script is ordered by entityID so that serial and parallel runs
+        # produce the same output
+        results = sorted([r for r in results if r.digest],
+                         key=lambda r: r.eid)
+        print "%d unique rulesets for %d Service Providers" % (
+            len(set([r.ruleset_key for r in results])), len(results))
+        for res in results:
+            eid = res.eid
+            if not res.written:
+                continue
+            if incremental and self.state.digest(eid) is not None:
+                changed.append(eid)
+                _template = pshUpdateTemplate
+            else:
+                added.append(eid)
+                _template = pshAddTemplate
+            metadataFile, rulesetFile = self.output_files(res.fname)
+            pshScript += _template.substitute(
+                fedName=self.fed_name_prefix,
+                metadataFile=metadataFile,
+                rpName=eid,
+                rulesetFile=rulesetFile)
+
+        if incremental:
+            removed = self.state.removed()
+            pshRemoveTemplate = self.templates["powershell_remove"]
+            pshScript = "".join([pshRemoveTemplate.substitute(
+                fedName=self.fed_name_prefix, rpName=eid)
+                for eid in removed]) + pshScript
+            if pshScript:
+                print "Generating powershell script for Relying Party " \
+                      "configuration update (%d added, %d updated, " \
+                      "%d removed)..." % (len(added), len(changed),
+                                          len(removed))
+                pshScriptBaseTemplate = self.templates[
+                    "powershell_incremental_base"]
+                pshScript = pshScriptBaseTemplate.substitute(
+                    fedName=self.fed_name_prefix) + pshScript
+            else:
+                print "No changes since the previous run"
+        elif pshScript:
             print "Generating powershell script for Relying Party configuration update..."
-            pshScriptBaseTemplate = Template(open(self.powershell_base,
-                                                  'r').read())
+            pshScriptBaseTemplate = self.templates["powershell_base"]
             pshScript = pshScriptBaseTemplate.substitute(
                 fedName=self.fed_name_prefix) + pshScript
-            pshScriptFile = open('update_adfs_rptrust.ps1', 'w')
-            pshScriptFile.write(pshScript)
-            pshScriptFile.close()
+
+        if pshScript:
+            self.state.save_pending()
+            pshCommitTemplate = self.templates["powershell_commit"]
+            pshScript += pshCommitTemplate.substitute(
+                pendingStateFile=self.state.pending_filename,
+                stateFile=self.state.deployed_filename)
+            with self.profiler.phase("commit"):
+                self.output.commit(pshScript)
+        else:
+            self.state.discard_pending()
+            with self.profiler.phase("commit"):
+                self.output.commit()
+
+
+def security_config(args):
+    """
+    pySAML2 configuration for signature verification, with the xmlsec binary
+    given on the command line
+    """
+    from saml2 import config
+
+    sec_config = config.Config()
+    if args.xmlsec:
+        sec_config.xmlsec_binary = args.xmlsec[0]
+    return sec_config
+
+
+def metadata_sources(fem, args):
+    """
+    The metadata sources given with -f and -u, in the order of precedence:
+    the local files come first, so they override the remote metadata,
+    otherwise a source given earlier comes first. Every source is verified
+    with its own certificate, or the one given with -c.
+
+    :return: The MetadataCache of every remote source, and the filename,
+        certificate and URL (None for a local file) of every source
+    """
+    caches = []
+    remote = []
+    for index, (url, cert) in enumerate(args.url):
+        name = METADATA_NAME
+        if index:
+            name = "%s-%d" % (METADATA_NAME, index + 1)
+        mdcache = MetadataCache(fem.cache_dir, url, fem.my_proxy, name)
+        mdcache.load()
+        caches.append(mdcache)
+        remote.append((mdcache.filename, cert or args.cert, url))
+    local = [(filename, cert or args.cert, None)
+             for filename, cert in args.filename]
+    return caches, local + remote
+
+
+def verify(fem, args):
+    """
+    Only fetches the metadata, if remote, and verifies its signature.
+    """
+    caches, sources = metadata_sources(fem, args)
+    for filename, cert, url in sources:
+        if not cert:
+            raise MetadataError("a certificate (-c) is needed to verify the "
+                                "signature of %s" % (url or filename))
+    fetch_metadata(caches)
+    fem.signature_cache.load()
+    sec_config = security_config(args)
+    for filename, cert, url in sources:
+        if not verify_signature(sec_config, filename, cert,
+                                fem.signature_cache):
+            raise MetadataError(
+                "signature verification failed for %s" % (url or filename))
+        print "Signature of %s verified" % (url or filename)
+
+
+def run(fem, args, local_changed=True, pending=True):
+    """
+    Fetches, verifies and extracts the metadata, unless nothing changed
+    since the last run.
+
+    :param local_changed: Whether the local metadata files (-f) should be
+        treated as changed
+    :param pending: Whether to extract again as long as the powershell
+        script of the previous run hasn't been run
+    :return: The MetadataCache of every remote source and whether extract
+        was run
+    """
+    caches, sources = metadata_sources(fem, args)
+    changed = local_changed and bool(args.filename)
+    if caches:
+        with fem.profiler.phase("fetch"):
+            remote_changed = fetch_metadata(caches)
+        changed = (changed or True in remote_changed or
+                   not all([c.info.get("extracted") for c in caches]))
+    if not (changed or args.force or args.plan or
+            (pending and os.path.exists(fem.state.pending_filename))):
+        # Changed settings or templates have to be deployed as well
+        fem.state.load()
+        if fem.context(args.raw_xml if args.stream else None) == \
+                fem.state.context:
+            print "Metadata from %s has not changed, nothing to do" % \
+                  ", ".join([url or filename
+                             for filename, cert, url in sources])
+            return caches, False
+        print "Settings or templates changed since the previous run"
+
+    fem.signature_cache.load()
+    if not args.stream or [cert for _, cert, _ in sources if cert]:
+        sec_config = security_config(args)
+    for filename, cert, url in sources:
+        if cert:
+            with fem.profiler.phase("verify"):
+                verified = verify_signature(
+                    sec_config, filename, cert, fem.signature_cache)
+            if not verified:
+                raise MetadataError("signature verification failed for "
+                                    "%s" % (url or filename))
+    if args.stream:
+        fem.mds = MetadataStream([filename for filename, _, _ in sources],
+                                 raw=args.raw_xml)
+    else:
+        attrconv = attribute_converters(
+            cache_file=pjoin(fem.cache_dir, ATTRIBUTE_MAP_CACHE_FILE))
+        from saml2.mdstore import MetadataStore
+
+        mds = MetadataStore(onts().values(), attrconv, sec_config,
+                            disable_ssl_certificate_validation=True)
+        for filename, _, _ in sources:
+            with fem.profiler.phase("parse"):
+                mds.load("local", filename)
+        fem.mds = MergedMetadataStore(
+            mds, [filename for filename, _, _ in sources])
+
+    with fem.profiler.phase("extract"):
+        fem.extract(args.incremental, args.workers, args.plan)
+    fem.mds = None
+    if not args.plan:
+        for mdcache in caches:
+            mdcache.extracted()
+    return caches, True
+
+
+def _file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def daemon(fem, args):
+    """
+    Keeps running with the same Femma instance, so the templates, rule
+    caches and settings lookups stay in memory between runs. The remote
+    metadata is refreshed when its cacheDuration or validUntil says so,
+    otherwise every --interval seconds, and the output is only regenerated
+    when the metadata, the local metadata files, the settings or the
+    templates changed.
+    """
+    settings = _file_signature(fem.settings_file)
+    templates = fem.templates.digest
+    local = [_file_signature(filename) for filename, _ in args.filename]
+    first = True
+    while True:
+        if not first:
+            _settings = _file_signature(fem.settings_file)
+            _templates = TemplateRegistry([fem.template_dir,
+                                           fem.custom_rules_dir]).digest
+            if _settings != settings or _templates != templates:
+                print "Settings or templates changed, reloading"
+                settings = _settings
+                fem.setup()
+                templates = fem.templates.digest
+                fem.check_xml = args.check_xml
+                # Everything has to be redone with the new settings
+                args.force = True
+        if args.profile:
+            fem.profiler = Profiler()
+        _local = [_file_signature(filename) for filename, _ in args.filename]
+        delay = args.min_interval
+        try:
+            caches, extracted = run(fem, args, first or _local != local,
+                                    first)
+            local = _local
+            delay = args.interval
+            expires = [c.expires() for c in caches]
+            expires = [e for e in expires if e is not None]
+            if expires:
+                delay = min(expires) - time.time()
+            if (args.command and extracted and
+                    os.path.exists(fem.ps1_filename)):
+                print "Running %s" % args.command
+                os.system(args.command)
+        except Exception, e:
+            print "ERROR: %s" % e
+        if args.profile:
+            fem.profiler.save(args.profile, args.profile_top)
+        first = False
+        args.force = False
+        delay = max(delay, args.min_interval)
+        print "Next refresh in %d seconds" % delay
+        time.sleep(delay)
 
 
 if __name__ == "__main__":
     _parser = argparse.ArgumentParser()
-    _parser.add_argument('-u', dest='url', nargs="?",
-                         help='URL of federation metadata')
-    _parser.add_argument('-f', dest='filename', nargs="?",
-                         help='filename of federation metadata')
+    _parser.add_argument('-u', dest='url', nargs="+", action="append",
+                         default=[], metavar=("URL", "CERT"),
+                         help='URL of federation metadata, optionally with '
+                              'the certificate for its signature, can be '
+                              'given more than once')
+    _parser.add_argument('-f', dest='filename', nargs="+", action="append",
+                         default=[], metavar=("FILENAME", "CERT"),
+                         help='filename of federation metadata, optionally '
+                              'with the certificate for its signature, can '
+                              'be given more than once')
     _parser.add_argument(
         '-x', dest='xmlsec', nargs=1,
         help='path to xmlsec binary for signature verification')
     _parser.add_argument(
         '-c', dest='cert', nargs="?", default="",
-        help='certificate for signature verification')
+        help='certificate for signature verification of the sources given '
+             'without one')
     _parser.add_argument(
         '-C', dest='clear', action='store_true', help='clean up')
+    _parser.add_argument(
+        '-V', dest='verify', action='store_true',
+        help='only verify the signature of the metadata, with the '
+             'certificates given with the sources or -c')
+    _parser.add_argument(
+        '-i', dest='incremental', action='store_true',
+        help='only add, update and remove the relying party trusts that '
+             'changed since the last deployed run')
+    _parser.add_argument(
+        '--plan', dest='plan', action='store_true',
+        help='only print which relying party trusts would be added, updated '
+             'and removed, without touching the output or the deployment '
+             'state; the metadata, signature and attribute map caches are '
+             'updated as in a normal run')
+    _parser.add_argument(
+        '--workers', dest='workers', type=int, default=1,
+        help='number of processes handling entities in parallel')
+    _parser.add_argument(
+        '-F', dest='force', action='store_true',
+        help='extract even if the remote metadata has not changed')
+    _parser.add_argument(
+        '-s', dest='stream', action='store_true',
+        help='parse the metadata one entity at a time instead of loading '
+             'all of it into memory')
+    _parser.add_argument(
+        '--output-dir', dest='output_dir', default="",
+        help='directory to write the metadata, rulesets and powershell '
+             'script to, defaults to the current directory')
+    _parser.add_argument(
+        '-X', dest='raw_xml', action='store_true',
+        help='filter and write the metadata as XML elements instead of '
+             'going through pySAML2 objects, implies -s')
+    _parser.add_argument(
+        '--check-xml', dest='check_xml', action='store_true',
+        help='with -X, report entities where the result differs from the '
+             'pySAML2 based serialization')
+    _parser.add_argument(
+        '--profile', dest='profile', default="",
+        help='write the time spent per phase and per entity, as JSON, to '
+             'this file')
+    _parser.add_argument(
+        '--profile-top', dest='profile_top', type=int, default=20,
+        help='number of the slowest entities to include in the profile')
+    _parser.add_argument(
+        '--profile-stats', dest='profile_stats', default="",
+        help='dump cProfile statistics of the main process to this file')
+    _parser.add_argument(
+        '--daemon', dest='daemon', action='store_true',
+        help='keep running and refresh the metadata when its cacheDuration '
+             'or validUntil says so')
+    _parser.add_argument(
+        '--interval', dest='interval', type=int, default=3600,
+        help='seconds between refreshes in daemon mode when the metadata '
+             'has no cacheDuration or validUntil')
+    _parser.add_argument(
+        '--min-interval', dest='min_interval', type=int, default=300,
+        help='minimum number of seconds between refreshes in daemon mode, '
+             'also the delay before retrying after an error')
+    _parser.add_argument(
+        '--command', dest='command', default="",
+        help='in daemon mode, command to run when a new powershell script '
+             'has been generated')
 
     args = _parser.parse_args()
-
-    if args.clear:
-        fem = Femma(None)
+    for _sources in [args.url, args.filename]:
+        for _index, _source in enumerate(_sources):
+            if len(_source) > 2:
+                _parser.error("more than a certificate given for %s" %
+                              _source[0])
+            _sources[_index] = (_source[0], "".join(_source[1:]))
+
+    fem = Femma(None)
+    fem.output_dir = args.output_dir
+    try:
         fem.setup()
+    except ValueError, e:
+        print "ERROR: %s" % e
+        sys.exit(1)
+    if args.clear:
         fem.clean_up()
+    elif args.verify:
+        try:
+            verify(fem, args)
+        except MetadataError, e:
+            print "ERROR: %s" % e
+            sys.exit(1)
     else:
-        sec_config = config.Config()
-        sec_config.xmlsec_binary = args.xmlsec[0]
-        mds = MetadataStore(ONTS.values(), ATTRCONV, sec_config,
-                            disable_ssl_certificate_validation=True)
-        if args.url:
-            mds.load("remote", url=args.url, cert=args.cert)
-        if args.filename:
-            if args.cert:
-                mds.load("local", args.filename, cert=args.cert)
-            else:
-                mds.load("local", args.filename)
-
+        fem.check_xml = args.check_xml
+        if args.raw_xml:
+            args.stream = True
+        if args.daemon and not args.plan:
+            daemon(fem, args)
+
+        if args.profile:
+            fem.profiler = Profiler()
+        if args.profile_stats:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            run(fem, args)
+        except MetadataError, e:
+            print "ERROR: %s" % e
+            sys.exit(1)
 
-        fem = Femma(mds)
-        fem.setup()
-        fem.extract()
+        if args.profile_stats:
+            profile.disable()
+            profile.dump_stats(args.profile_stats)
+        if args.profile:
+            fem.profiler.save(args.profile, args.profile_top)
+            print "Profile written to %s" % args.profile
@@ -1,4 +1,6 @@
 Add-PSSnapin Microsoft.Adfs.PowerShell
+$$ErrorActionPreference = "Stop"
 $$stsproperties = Get-ADFSSyncProperties
 if (-not ($$stsproperties.role -eq "PrimaryComputer")) { exit }
+$$failed = @()
 Get-ADFSRelyingPartyTrust | Where-Object {$$_.Name -like "($fedName)*"} | ForEach-Object {Remove-ADFSRelyingPartyTrust -TargetName $$_.Name}
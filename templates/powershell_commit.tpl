@@ -0,0 +1,2 @@
+$$failed | Add-Content -Encoding UTF8 -Path "$pendingStateFile"
+Move-Item -Force -Path "$pendingStateFile" -Destination "$stateFile"
@@ -0,0 +1,5 @@
+Add-PSSnapin Microsoft.Adfs.PowerShell
+$$ErrorActionPreference = "Stop"
+$$stsproperties = Get-ADFSSyncProperties
+if (-not ($$stsproperties.role -eq "PrimaryComputer")) { exit }
+$$failed = @()
@@ -0,0 +1,8 @@
+try {
+    if (Get-ADFSRelyingPartyTrust -Name "($fedName) $rpName") {
+        Remove-ADFSRelyingPartyTrust -TargetName "($fedName) $rpName"
+    }
+} catch {
+    Write-Warning "($fedName) $rpName: $$_"
+    $$failed += "$rpName"
+}
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Measures how the per entity settings lookups of pysFemma scale with the
+# number of excluded entityIDs (exact and prefix glob patterns) and
+# configured Service Providers.
+#
+# example:
+#   cd <pysfemma dir>; python tools/bench_config_index.py
+#
+# The time per lookup should stay flat as the number of entries grows.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from os.path import join as pjoin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = """[Settings]
+idpEntityID=https://idp.example.org/idp
+spEntityID=https://idp.example.org/idp
+myClaimType=http://example.org/claims
+fedNamePrefix=BENCH
+myProxy=
+myProxyPort=
+
+[SensitiveAttributes]
+rules = persistent,eppn,mail
+
+[Attributes]
+mail=mail,emailaddress
+"""
+
+
+def write_settings(filename, size):
+    fp = open(filename, "w")
+    fp.write(SETTINGS)
+    fp.write("\n[ExcludeEntityID]\n")
+    for i in range(size):
+        fp.write("x%d = https://excluded%d.example.org/sp\n" % (i, i))
+        fp.write("p%d = glob:https://prefix%d.example.org/*\n" % (i, i))
+    # globs that aren't plain prefixes share one regular expression, a
+    # fixed number of them is used
+    for i in range(100):
+        fp.write("g%d = glob:https://*.glob%d.example.org/*\n" % (i, i))
+    fp.write("\n[ServiceProviderAttributes]\n")
+    for i in range(size):
+        fp.write("sp%d.example.org/shibboleth=persistent,mail\n" % i)
+    fp.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='number', type=int, default=2000,
+                        help='lookups per measurement')
+    parser.add_argument('sizes', nargs="*", type=int,
+                        default=[10, 100, 1000, 10000, 100000])
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    import pysfemma
+
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copytree(pjoin(ROOT, "templates"), pjoin(workdir, "templates"))
+        os.chdir(workdir)
+        print "%8s %16s %16s %16s %16s" % (
+            "entries", "exclude (us)", "pattern (us)", "persistent (us)",
+            "setup (s)")
+        for size in args.sizes:
+            settings = pjoin(workdir, "settings%d.cfg" % size)
+            write_settings(settings, size)
+            fem = pysfemma.Femma(None, settings)
+            start = timeit.default_timer()
+            fem.setup()
+            setup_time = timeit.default_timer() - start
+
+            probes = ["https://excluded%d.example.org/sp" % (size - 1),
+                      "https://notexcluded.example.org/sp"]
+            exclude = timeit.timeit(
+                lambda: [fem.entity_to_ignore(p) for p in probes],
+                number=args.number) / (args.number * len(probes))
+            probes = ["https://prefix%d.example.org/sp" % (size - 1),
+                      "https://sp.glob99.example.org/sp"]
+            pattern = timeit.timeit(
+                lambda: [fem.entity_to_ignore(p) for p in probes],
+                number=args.number) / (args.number * len(probes))
+            probes = ["https://sp%d.example.org/shibboleth" % (size - 1),
+                      "https://unknown.example.org/shibboleth"]
+            persistent = timeit.timeit(
+                lambda: [fem.is_persistent(p) for p in probes],
+                number=args.number) / (args.number * len(probes))
+            print "%8d %16.3f %16.3f %16.3f %16.3f" % (
+                size, exclude * 1e6, pattern * 1e6, persistent * 1e6,
+                setup_time)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+#
+# Measures how Femma.extract behaves as the federation grows. Synthetic
+# aggregates are generated with a mix of Service Providers like the one
+# found in real federations: rollover keys marked Standby, expired
+# certificates, unsupported bindings, plain HTTP endpoints, entity categories
+# and registration authorities, plus some Identity Providers. Every run is
+# done in a separate process, with the phases timed by the pysFemma profiler
+# and the peak memory use taken from getrusage.
+#
+# example:
+#   cd <pysfemma dir>; python tools/bench_extract.py --json bench.json 1000
+#
+# With -x the aggregates are signed with xmlsec1 and the signature
+# verification is timed as well. Nothing needs network access.
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from os.path import join as pjoin
+
+from OpenSSL import crypto
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["store", "stream", "xml"]
+
+SETTINGS = """[Settings]
+idpEntityID=https://idp.example.org/idp
+spEntityID=https://idp.example.org/idp
+myClaimType=http://example.org/claims
+fedNamePrefix=BENCH
+myProxy=
+myProxyPort=
+%s
+[SensitiveAttributes]
+rules = persistent,eppn,mail
+
+[Attributes]
+mail=mail,emailaddress
+"""
+
+NAMESPACES = (
+    'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+    'xmlns:ds="http://www.w3.org/2000/09/xmldsig#" '
+    'xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute" '
+    'xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi" '
+    'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"')
+
+SIGNATURE_TEMPLATE = """<ds:Signature>
+<ds:SignedInfo>
+<ds:CanonicalizationMethod Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/>
+<ds:SignatureMethod Algorithm="http://www.w3.org/2001/04/xmldsig-more#rsa-sha256"/>
+<ds:Reference URI="#bench">
+<ds:Transforms>
+<ds:Transform Algorithm="http://www.w3.org/2000/09/xmldsig#enveloped-signature"/>
+<ds:Transform Algorithm="http://www.w3.org/2001/10/xml-exc-c14n#"/>
+</ds:Transforms>
+<ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>
+<ds:DigestValue/>
+</ds:Reference>
+</ds:SignedInfo>
+<ds:SignatureValue/>
+<ds:KeyInfo><ds:X509Data/></ds:KeyInfo>
+</ds:Signature>
+"""
+
+KEY_DESCRIPTOR = """<md:KeyDescriptor><ds:KeyInfo>%s<ds:X509Data>\
+<ds:X509Certificate>%s</ds:X509Certificate></ds:X509Data></ds:KeyInfo>\
+</md:KeyDescriptor>
+"""
+
+CATEGORIES = [
+    "http://refeds.org/category/research-and-scholarship",
+    "http://www.geant.net/uri/dataprotection-code-of-conduct/v1",
+    "http://www.swamid.se/category/sfs-1993-1153",
+    "http://www.swamid.se/category/research-and-education"]
+
+AUTHORITIES = ["http://www.swamid.se/", "http://www.idem.garr.it/",
+               "http://ukfederation.org.uk", "https://incommon.org"]
+
+POST = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+REDIRECT = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+ARTIFACT = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Artifact"
+PAOS = "urn:oasis:names:tc:SAML:2.0:bindings:PAOS"
+SOAP = "urn:oasis:names:tc:SAML:2.0:bindings:SOAP"
+
+
+def make_key(bits):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    return key
+
+
+def make_cert(key, name, serial, not_before, not_after):
+    cert = crypto.X509()
+    cert.get_subject().CN = name
+    cert.set_serial_number(serial)
+    cert.gmtime_adj_notBefore(not_before)
+    cert.gmtime_adj_notAfter(not_after)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    return cert
+
+
+def cert_pool(key, valid, expired):
+    """
+    Certificates as they appear in metadata, base64 encoded DER. All use the
+    same key, generating keys would dominate the time taken.
+    """
+    year = 365 * 24 * 3600
+    res = {"valid": [], "expired": []}
+    for i in range(valid + expired):
+        if i < valid:
+            cert = make_cert(key, "sp%d.example.org" % i, i + 1, -year,
+                             10 * year)
+            kind = "valid"
+        else:
+            cert = make_cert(key, "sp%d.example.org" % i, i + 1, -3 * year,
+                             -year)
+            kind = "expired"
+        res[kind].append(base64.b64encode(
+            crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)))
+    return res
+
+
+def endpoint(tag, binding, location, index=None):
+    if index is None:
+        return '<md:%s Binding="%s" Location="%s"/>\n' % (tag, binding,
+                                                         location)
+    return '<md:%s Binding="%s" Location="%s" index="%d"/>\n' % (
+        tag, binding, location, index)
+
+
+def service_provider(rnd, i, certs):
+    """
+    One SPSSODescriptor based EntityDescriptor. About 5% of them end up
+    without working keys and 6% without usable endpoints.
+    """
+    host = "https://sp%d.example.org" % i
+    keys = []
+    draw = rnd.random()
+    if draw < 0.05:
+        keys.append(("", rnd.choice(certs["expired"])))
+    elif draw < 0.10:
+        keys.append(("", rnd.choice(certs["expired"])))
+        keys.append(("", rnd.choice(certs["valid"])))
+    elif draw < 0.20:
+        # rollover in progress
+        keys.append(("", rnd.choice(certs["valid"])))
+        keys.append(("<ds:KeyName>Standby</ds:KeyName>",
+                     rnd.choice(certs["valid"])))
+    else:
+        keys.append(("", rnd.choice(certs["valid"])))
+
+    acs = []
+    draw = rnd.random()
+    if draw < 0.03:
+        acs.append((ARTIFACT, host + "/Shibboleth.sso/SAML2/Artifact"))
+    elif draw < 0.06:
+        acs.append((POST, host.replace("https:", "http:") +
+                    "/Shibboleth.sso/SAML2/POST"))
+    else:
+        acs.append((POST, host + "/Shibboleth.sso/SAML2/POST"))
+        if rnd.random() < 0.4:
+            acs.append((ARTIFACT, host + "/Shibboleth.sso/SAML2/Artifact"))
+        if rnd.random() < 0.2:
+            acs.append((PAOS, host + "/Shibboleth.sso/SAML2/ECP"))
+
+    extensions = '<mdrpi:RegistrationInfo registrationAuthority="%s"/>' % (
+        rnd.choice(AUTHORITIES),)
+    if rnd.random() < 0.4:
+        values = rnd.sample(CATEGORIES, rnd.randint(1, 2))
+        extensions += (
+            '<mdattr:EntityAttributes><saml:Attribute '
+            'Name="http://macedir.org/entity-category" '
+            'NameFormat="urn:oasis:names:tc:SAML:2.0:attrname-format:uri">%s'
+            '</saml:Attribute></mdattr:EntityAttributes>' % "".join(
+                ["<saml:AttributeValue>%s</saml:AttributeValue>" % v
+                 for v in values]))
+
+    res = ['<md:EntityDescriptor entityID="%s/shibboleth">\n' % host,
+           '<md:Extensions>%s</md:Extensions>\n' % extensions,
+           '<md:SPSSODescriptor protocolSupportEnumeration='
+           '"urn:oasis:names:tc:SAML:2.0:protocol">\n']
+    for key_name, cert in keys:
+        res.append(KEY_DESCRIPTOR % (key_name, cert))
+    res.append(endpoint("SingleLogoutService", REDIRECT,
+                        host + "/Shibboleth.sso/SLO/Redirect"))
+    if rnd.random() < 0.5:
+        res.append(endpoint("SingleLogoutService", SOAP,
+                            host + "/Shibboleth.sso/SLO/SOAP"))
+    res.append("<md:NameIDFormat>urn:oasis:names:tc:SAML:2.0:nameid-format:"
+               "transient</md:NameIDFormat>\n")
+    for index, (binding, location) in enumerate(acs):
+        res.append(endpoint("AssertionConsumerService", binding, location,
+                            index + 1))
+    res.append('</md:SPSSODescriptor>\n<md:Organization>'
+               '<md:OrganizationName xml:lang="en">Org %d'
+               '</md:OrganizationName><md:OrganizationDisplayName '
+               'xml:lang="en">Org %d</md:OrganizationDisplayName>'
+               '<md:OrganizationURL xml:lang="en">%s/</md:OrganizationURL>'
+               '</md:Organization>\n</md:EntityDescriptor>\n' % (i, i, host))
+    return "".join(res)
+
+
+def identity_provider(rnd, i, certs):
+    host = "https://idp%d.example.org" % i
+    return (
+        '<md:EntityDescriptor entityID="%s/idp/shibboleth">\n'
+        '<md:IDPSSODescriptor protocolSupportEnumeration='
+        '"urn:oasis:names:tc:SAML:2.0:protocol">\n%s%s'
+        '</md:IDPSSODescriptor>\n</md:EntityDescriptor>\n' % (
+            host, KEY_DESCRIPTOR % ("", rnd.choice(certs["valid"])),
+            endpoint("SingleSignOnService", REDIRECT,
+                     host + "/idp/profile/SAML2/Redirect/SSO")))
+
+
+def write_aggregate(filename, size, certs, seed, signed=False):
+    """
+    :param size: Number of Service Providers, a tenth of that number of
+        Identity Providers is added
+    """
+    rnd = random.Random(seed)
+    fp = open(filename, "w")
+    fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<md:EntitiesDescriptor %s ID="bench" Name="bench" '
+             'cacheDuration="PT1H">\n' % NAMESPACES)
+    if signed:
+        fp.write(SIGNATURE_TEMPLATE)
+    for i in range(size):
+        fp.write(service_provider(rnd, i, certs))
+        if i % 10 == 0:
+            fp.write(identity_provider(rnd, i, certs))
+    fp.write('</md:EntitiesDescriptor>\n')
+    fp.close()
+
+
+def sign(xmlsec, filename, key_file, cert_file):
+    signed = filename + ".signed"
+    cmd = "%s --sign --privkey-pem %s,%s --id-attr:ID %s --output %s %s" % (
+        xmlsec, key_file, cert_file,
+        "urn:oasis:names:tc:SAML:2.0:metadata:EntitiesDescriptor", signed,
+        filename)
+    if os.system(cmd) != 0:
+        raise Exception("signing with %s failed" % xmlsec)
+    os.rename(signed, filename)
+
+
+def run(conn, workdir, filename, mode, workers, incremental, xmlsec,
+        cert_file):
+    """
+    Runs extract in a process of its own, the result is sent through conn.
+    """
+    sys.stdout = open(os.devnull, "w")
+    try:
+        import pysfemma
+        from saml2 import config
+
+        os.chdir(workdir)
+        sec_config = config.Config()
+        sec_config.xmlsec_binary = xmlsec
+        fem = pysfemma.Femma(None)
+        fem.setup()
+        fem.profiler = pysfemma.Profiler()
+        if cert_file:
+            with fem.profiler.phase("verify"):
+                if not pysfemma.verify_signature(sec_config, filename,
+                                                 cert_file):
+                    raise Exception("signature verification failed")
+        if mode == "store":
+            from saml2.mdstore import MetadataStore
+
+            fem.mds = MetadataStore(
+                pysfemma.onts().values(),
+                pysfemma.attribute_converters(pjoin(ROOT, "attributemaps")),
+                sec_config,
+                disable_ssl_certificate_validation=True)
+            with fem.profiler.phase("parse"):
+                fem.mds.load("local", filename)
+        else:
+            fem.mds = pysfemma.MetadataStream([filename],
+                                              raw=(mode == "xml"))
+        with fem.profiler.phase("extract"):
+            fem.extract(incremental, workers)
+        report = fem.profiler.report(0)
+        report["exported"] = fem.state.summary().get("exported", 0)
+        conn.send(report)
+    except Exception, e:
+        conn.send({"error": "%s: %s" % (e.__class__.__name__, e)})
+    conn.close()
+
+
+def measure(workdir, filename, mode, workers, incremental=False, xmlsec="",
+            cert_file=""):
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=run, args=(child, workdir, filename, mode, workers,
+                          incremental, xmlsec, cert_file))
+    proc.start()
+    res = parent.recv()
+    proc.join()
+    return res
+
+
+def deploy(workdir):
+    """
+    Pretends the powershell script has been run, the pending state becomes
+    the deployed one
+    """
+    cache = pjoin(workdir, "cache")
+    if os.path.exists(pjoin(cache, "state.db.pending")):
+        os.rename(pjoin(cache, "state.db.pending"),
+                  pjoin(cache, "state.db.deployed"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', dest='modes', action='append', choices=MODES,
+                        help='how the metadata is read: store (MetadataStore),'
+                             ' stream (-s) or xml (-X), default all')
+    parser.add_argument('-w', dest='workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('-x', dest='xmlsec', default="",
+                        help='path to xmlsec1, sign the aggregates and time '
+                             'the signature verification')
+    parser.add_argument('-i', dest='incremental', action='store_true',
+                        help='also time an incremental run over the same '
+                             'aggregate')
+    parser.add_argument('--categories', dest='categories', default="",
+                        help='entityCategories setting, e.g. edugain')
+    parser.add_argument('--certs', dest='certs', type=int, default=40,
+                        help='size of the certificate pool')
+    parser.add_argument('--seed', dest='seed', type=int, default=1)
+    parser.add_argument('--json', dest='json', default="",
+                        help='write the results to this file')
+    parser.add_argument('sizes', nargs="*", type=int,
+                        default=[1000, 10000, 60000])
+    args = parser.parse_args()
+    modes = args.modes or MODES
+
+    sys.path.insert(0, ROOT)
+
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        shutil.copytree(pjoin(ROOT, "templates"), pjoin(workdir, "templates"))
+        fp = open(pjoin(workdir, "settings.cfg"), "w")
+        if args.categories:
+            fp.write(SETTINGS % ("entityCategories=%s\n" % args.categories))
+        else:
+            fp.write(SETTINGS % "")
+        fp.close()
+
+        key = make_key(2048)
+        certs = cert_pool(key, args.certs - args.certs / 5, args.certs / 5)
+        key_file = cert_file = ""
+        if args.xmlsec:
+            key_file = pjoin(workdir, "sign.key")
+            cert_file = pjoin(workdir, "sign.crt")
+            fp = open(key_file, "w")
+            fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+            fp.close()
+            fp = open(cert_file, "w")
+            fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, make_cert(
+                key, "metadata signer", 1, -3600, 365 * 24 * 3600)))
+            fp.close()
+
+        print "%8s %8s %12s %8s %10s %10s %10s %12s" % (
+            "SPs", "mode", "pass", "exported", "wall (s)", "cpu (s)",
+            "parse (s)", "peak RSS")
+        for size in args.sizes:
+            filename = pjoin(workdir, "aggregate%d.xml" % size)
+            start = time.time()
+            write_aggregate(filename, size, certs, args.seed,
+                            bool(args.xmlsec))
+            if args.xmlsec:
+                sign(args.xmlsec, filename, key_file, cert_file)
+            generated = time.time() - start
+
+            passes = [("full", False)]
+            if args.incremental:
+                passes.append(("incremental", True))
+            for mode in modes:
+                shutil.rmtree(pjoin(workdir, "cache"), True)
+                for name, incremental in passes:
+                    res = measure(workdir, filename, mode, args.workers,
+                                  incremental, args.xmlsec, cert_file)
+                    res.update({"size": size, "mode": mode, "pass": name,
+                                "workers": args.workers,
+                                "bytes": os.path.getsize(filename),
+                                "generate": generated})
+                    results.append(res)
+                    if "error" in res:
+                        print "%8d %8s %12s %s" % (size, mode, name,
+                                                   res["error"])
+                        break
+                    try:
+                        parse = res["phases"]["parse"]["wall"]
+                    except KeyError:
+                        parse = 0.0
+                    if res["peak_rss"]:
+                        rss = "%d" % res["peak_rss"]["self"]
+                    else:
+                        rss = "-"
+                    print "%8d %8s %12s %8d %10.2f %10.2f %10.2f %12s" % (
+                        size, mode, name, res["exported"],
+                        res["total"]["wall"], res["total"]["cpu"], parse,
+                        rss)
+                    deploy(workdir)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, True)
+
+    if args.json:
+        fp = open(args.json, "w")
+        json.dump(results, fp, sort_keys=True, indent=1)
+        fp.close()
+
+
+if __name__ == "__main__":
+    main()
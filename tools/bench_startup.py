@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Measures how long pysFemma takes to start, by running the commands that
+# do little besides starting (importing the module, --help and -C) in fresh
+# Python processes, and counts the pySAML2 modules loaded by the import.
+#
+# example:
+#   cd <pysfemma dir>; python tools/bench_startup.py -n 20
+#
+# Importing pysfemma should not load any pySAML2 module.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from os.path import join as pjoin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = pjoin(ROOT, "pysfemma.py")
+
+IMPORT = """import sys
+sys.path.insert(0, %r)
+import pysfemma
+print len([m for m in sys.modules if m.split(".")[0] == "saml2"])
+""" % ROOT
+
+
+def measure(cmd, number, cwd):
+    devnull = open(os.devnull, "w")
+    times = []
+    for _ in range(number):
+        start = timeit.default_timer()
+        subprocess.check_call(cmd, stdout=devnull, cwd=cwd)
+        times.append(timeit.default_timer() - start)
+    devnull.close()
+    return min(times), sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='number', type=int, default=10,
+                        help='runs per command')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copytree(pjoin(ROOT, "templates"), pjoin(workdir, "templates"))
+        shutil.copy(pjoin(ROOT, "settings.cfg"), workdir)
+
+        modules = subprocess.Popen(
+            [sys.executable, "-c", IMPORT], stdout=subprocess.PIPE,
+            cwd=workdir).communicate()[0].strip()
+        print "pySAML2 modules loaded by the import: %s" % modules
+
+        print "%12s %12s %12s" % ("command", "min (s)", "mean (s)")
+        for name, cmd in [
+                ("python", [sys.executable, "-c", "pass"]),
+                ("import", [sys.executable, "-c", IMPORT]),
+                ("--help", [sys.executable, SCRIPT, "--help"]),
+                ("-C", [sys.executable, SCRIPT, "-C"])]:
+            print "%12s %12.3f %12.3f" % ((name,) + measure(cmd, args.number,
+                                                            workdir))
+    finally:
+        shutil.rmtree(workdir, True)
+
+
+if __name__ == "__main__":
+    main()
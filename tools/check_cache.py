@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Checks the conditional fetching of remote metadata by MetadataCache against
+# a stand-in HTTP server on localhost: the first fetch downloads the document,
+# the copy is then fresh for its cacheDuration, once that has passed the
+# server answers 304 to the ETag, and a changed document is downloaded again.
+# Nothing needs network access.
+#
+# example:
+#   cd <pysfemma dir>; python tools/check_cache.py
+
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pysfemma import MetadataCache
+
+DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    Name="check" %s>
+  <md:EntityDescriptor entityID="https://sp.example.org/%s"/>
+</md:EntitiesDescriptor>
+"""
+
+LAST_MODIFIED = "Sat, 01 Jan 2000 00:00:00 GMT"
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    body = ""
+    requests = []
+
+    def do_GET(self):
+        etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+        if_none_match = self.headers.getheader("If-None-Match")
+        status = 304 if if_none_match == etag else 200
+        self.requests.append(
+            (if_none_match, self.headers.getheader("If-Modified-Since"),
+             status))
+        if status == 304:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Checker(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.failed = 0
+
+    def fetch(self, description, downloaded, status, fresh):
+        del Handler.requests[:]
+        res = self.cache.fetch()
+        sent = Handler.requests[-1]
+        ok = (res == downloaded and sent[2] == status and
+              self.cache.fresh() == fresh)
+        print "%s %s: %d, fresh %s" % ("ok  " if ok else "FAIL", description,
+                                       sent[2], self.cache.fresh())
+        if not ok:
+            self.failed += 1
+        return sent
+
+    def check(self, description, value):
+        print "%s %s" % ("ok  " if value else "FAIL", description)
+        if not value:
+            self.failed += 1
+
+
+def main():
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/metadata.xml" % server.server_port
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = MetadataCache(directory, url)
+        checker = Checker(cache)
+
+        Handler.body = DOCUMENT % ('cacheDuration="PT1H"', "one")
+        cache.load()
+        checker.check("not fresh before the first fetch", not cache.fresh())
+        sent = checker.fetch("first fetch", True, 200, True)
+        checker.check("no conditional headers on the first fetch",
+                      sent[:2] == (None, None))
+
+        # A new run reads what the previous one saved
+        cache = MetadataCache(directory, url)
+        cache.load()
+        checker.cache = cache
+        checker.check("fresh within cacheDuration", cache.fresh())
+
+        cache.info["fetched"] -= 2 * 3600
+        checker.check("not fresh after cacheDuration", not cache.fresh())
+        sent = checker.fetch("unchanged document", False, 304, True)
+        checker.check("ETag and Last-Modified sent",
+                      sent[0] and sent[1] == LAST_MODIFIED)
+
+        Handler.body = DOCUMENT % ('cacheDuration="PT1H"', "two")
+        cache.info["fetched"] -= 2 * 3600
+        checker.fetch("changed document", True, 200, True)
+        checker.check("changed document stored",
+                      open(cache.filename).read() == Handler.body)
+
+        Handler.body = DOCUMENT % ("", "three")
+        cache.info["fetched"] -= 2 * 3600
+        checker.fetch("document without cacheDuration", True, 200, False)
+
+        Handler.body = DOCUMENT % (
+            'cacheDuration="PT1H" validUntil="2000-01-01T00:00:00Z"', "four")
+        checker.fetch("document past validUntil", True, 200, False)
+
+        cache = MetadataCache(directory, url + "?other")
+        cache.load()
+        checker.check("not fresh for another URL", not cache.fresh())
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+
+    if checker.failed:
+        print "%d checks failed" % checker.failed
+        sys.exit(1)
+    print "All checks passed"
+
+
+if __name__ == "__main__":
+    main()
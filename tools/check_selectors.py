@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Checks EntityMatcher on the selectors that can't simply be combined into
+# one regular expression: more groups than the re module of Python 2 allows
+# in a pattern, numbered and named backreferences, named groups that clash
+# with each other, inline flags and invalid expressions. The result of every
+# match is compared with trying the selectors one by one.
+#
+# example:
+#   cd <pysfemma dir>; python tools/check_selectors.py
+
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pysfemma import EntityMatcher
+from pysfemma import glob_to_regex
+from pysfemma import parse_selector
+
+SELECTORS = (
+    ["regex:^https://(sp|idp)%d\.example\.org/" % i for i in range(60)] +
+    [r"regex:^https://(a+)\.\1\.example\.com/",
+     r"regex:^https://(?P<r0>b+)\.(?P=r0)\.example\.com/",
+     r"regex:^https://(?P<r0>c+)\.example\.com/",
+     r"regex:^https://(x)?(?(1)y|z)\.example\.com/",
+     r"regex:(?i)^https://UPPER\.example\.com/",
+     "glob:https://*.example.net/sp?",
+     "https://sp5.example.org/exact",
+     "glob:https://prefix.example.org/*"] +
+    ["regex:^https://(((((((((g)))))))))%d\.example\.edu/" % i
+     for i in range(30)])
+
+ENTITY_IDS = (
+    ["https://sp%d.example.org/" % i for i in range(60)] +
+    ["https://idp59.example.org/", "https://aa.aa.example.com/",
+     "https://aa.a.example.com/", "https://bb.bb.example.com/",
+     "https://cc.example.com/", "https://xy.example.com/",
+     "https://z.example.com/", "https://xz.example.com/",
+     "https://upper.example.com/", "https://a.example.net/sp1",
+     "https://sp5.example.org/exact", "https://prefix.example.org/x",
+     "https://g29.example.edu/", "https://nothing.example.org/"])
+
+
+def expected(entity_id):
+    """
+    The index of the first selector that matches, tried one by one
+    """
+    for index, selector in enumerate(SELECTORS):
+        kind, pattern = parse_selector(selector)
+        if kind == "exact":
+            if pattern == entity_id:
+                return index
+            continue
+        if kind == "glob":
+            pattern = glob_to_regex(pattern)
+        if re.match(pattern, entity_id):
+            return index
+    return None
+
+
+def main():
+    failed = 0
+    matcher = EntityMatcher()
+    for index, selector in enumerate(SELECTORS):
+        matcher.add(selector, index)
+    matcher.compile()
+    print "%d selectors in %d regular expressions" % (len(matcher),
+                                                      len(matcher.regex))
+    for entity_id in ENTITY_IDS:
+        res = matcher.match(entity_id)
+        if res != expected(entity_id) or (
+                matcher.matches(entity_id) != (res is not None)):
+            print "FAIL %s: %s instead of %s" % (entity_id, res,
+                                                 expected(entity_id))
+            failed += 1
+
+    matcher = EntityMatcher()
+    try:
+        matcher.add("regex:^https://(unbalanced\.example\.org/")
+    except ValueError, e:
+        print "Invalid selector reported: %s" % e
+    else:
+        print "FAIL invalid selector accepted"
+        failed += 1
+
+    if failed:
+        print "%d checks failed" % failed
+        sys.exit(1)
+    print "All checks passed"
+
+
+if __name__ == "__main__":
+    main()
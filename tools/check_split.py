@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Checks split_entities on the documents it has to refuse, so that they are
+# parsed instead: other encodings, document type declarations, namespaces
+# declared below the root, unbalanced, nested and unterminated
+# EntityDescriptor elements. For the documents it accepts, every piece put
+# inside the root start tag must parse to the same element as the one found
+# by parsing the whole document.
+#
+# example:
+#   cd <pysfemma dir>; python tools/check_split.py
+
+import os
+import sys
+
+from lxml import etree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pysfemma import split_entities
+
+HEAD = '<?xml version="1.0" encoding="%s"?>\n'
+ROOT_TAG = ('<md:EntitiesDescriptor '
+            'xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" Name="check">')
+END = '</md:EntitiesDescriptor>\n'
+SP = ('<md:EntityDescriptor entityID="https://sp%d.example.org/">'
+      '<md:SPSSODescriptor protocolSupportEnumeration="x"/>'
+      '</md:EntityDescriptor>')
+
+
+def document(body, encoding="UTF-8", prolog=""):
+    return HEAD % encoding + prolog + ROOT_TAG + body + END
+
+ACCEPTED = (
+    ("plain", document(SP % 1 + SP % 2)),
+    ("ascii encoding", document(SP % 1, encoding="us-ascii")),
+    ("no XML declaration", ROOT_TAG + SP % 1 + END),
+    ("comments and processing instructions before the root",
+     document(SP % 1, prolog="<!-- <!DOCTYPE x> -->\n<?pi x?>\n")),
+    ("empty EntityDescriptor",
+     document('<md:EntityDescriptor entityID="https://sp1.example.org/"/>' +
+              SP % 2)),
+    ("tags in comments and CDATA",
+     document(SP % 1 + "<!-- <md:EntityDescriptor> -->" +
+              "<md:Extensions><![CDATA[</md:EntityDescriptor>]]>"
+              "</md:Extensions>" + SP % 2)),
+    ("'>' in attribute values",
+     document('<md:EntityDescriptor entityID="https://sp1.example.org/?a>b">'
+              '</md:EntityDescriptor>')),
+    ("nested EntitiesDescriptor",
+     document("<md:EntitiesDescriptor>" + SP % 1 +
+              "</md:EntitiesDescriptor>" + SP % 2)),
+    ("other prefix declared on the EntityDescriptor",
+     document('<m:EntityDescriptor '
+              'xmlns:m="urn:oasis:names:tc:SAML:2.0:metadata" '
+              'entityID="https://sp1.example.org/"></m:EntityDescriptor>')),
+)
+
+REFUSED = (
+    ("other encoding", document(SP % 1, encoding="ISO-8859-1")),
+    ("document type declaration",
+     document(SP % 1, prolog='<!DOCTYPE md:EntitiesDescriptor '
+                             '[<!ENTITY a "aaaa">]>\n')),
+    ("namespace declared on a nested EntitiesDescriptor",
+     document('<md:EntitiesDescriptor xmlns:x="urn:x">' + SP % 1 +
+              "</md:EntitiesDescriptor>")),
+    ("unbalanced EntityDescriptor",
+     document("</md:EntityDescriptor>" + SP % 1)),
+    ("nested EntityDescriptor",
+     document('<md:EntityDescriptor entityID="https://sp1.example.org/">' +
+              SP % 2 + "</md:EntityDescriptor>")),
+    ("unterminated EntityDescriptor",
+     document('<md:EntityDescriptor entityID="https://sp1.example.org/">')),
+    ("no root element", HEAD % "UTF-8" + "<!-- nothing -->\n"),
+)
+
+
+def parsed(data):
+    """
+    The EntityDescriptor elements found by parsing the whole document
+    """
+    root = etree.fromstring(data)
+    return [etree.tostring(elem, method="c14n") for elem in root.iter(
+        "{urn:oasis:names:tc:SAML:2.0:metadata}EntityDescriptor")]
+
+
+def main():
+    failed = 0
+    for description, data in ACCEPTED:
+        try:
+            root_tag, root_name, ranges = split_entities(data)
+        except ValueError, e:
+            print "FAIL %s refused: %s" % (description, e)
+            failed += 1
+            continue
+        pieces = [etree.tostring(etree.fromstring(
+            root_tag + data[start:end] + "</%s>" % root_name)[0],
+            method="c14n") for start, end in ranges]
+        if pieces != parsed(data):
+            print "FAIL %s split into %d pieces" % (description, len(pieces))
+            failed += 1
+        else:
+            print "ok   %s: %d pieces" % (description, len(pieces))
+
+    for description, data in REFUSED:
+        try:
+            split_entities(data)
+        except ValueError, e:
+            print "ok   %s refused: %s" % (description, e)
+        else:
+            print "FAIL %s accepted" % description
+            failed += 1
+
+    if failed:
+        print "%d checks failed" % failed
+        sys.exit(1)
+    print "All checks passed"
+
+
+if __name__ == "__main__":
+    main()
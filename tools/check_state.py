@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Checks the powershell scripts of incremental runs together with the
+# pending/deployed marker cycle of the state. The scripts are not run, what
+# the powershell_commit step does is done here instead, optionally with
+# relying party trusts the script failed for: the first run recreates
+# everything, a run after the script went through has nothing to do, a run
+# after a script that didn't get to its end generates the same changes
+# again, and the trusts the script failed for are retried, and only those.
+# Nothing needs network access.
+#
+# example:
+#   cd <pysfemma dir>; python tools/check_state.py
+
+import base64
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from os.path import join as pjoin
+
+from OpenSSL import crypto
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pysfemma
+
+from bench_extract import KEY_DESCRIPTOR
+from bench_extract import NAMESPACES
+from bench_extract import SETTINGS
+from bench_extract import make_cert
+from bench_extract import make_key
+
+SP = """<md:EntityDescriptor entityID="https://sp%d.example.org/shibboleth">
+<md:SPSSODescriptor protocolSupportEnumeration=\
+"urn:oasis:names:tc:SAML:2.0:protocol">
+%s<md:AssertionConsumerService \
+Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" \
+Location="https://sp%d.example.org/Shibboleth.sso/SAML2/POST" index="1"/>
+</md:SPSSODescriptor>
+</md:EntityDescriptor>
+"""
+
+SUMMARY_RE = re.compile(r"\((\d+) added, (\d+) updated, (\d+) removed\)")
+ENTITY_RE = re.compile(r'\$failed \+= "(.*)"')
+
+
+def eid(i):
+    return "https://sp%d.example.org/shibboleth" % i
+
+
+class Checker(object):
+    def __init__(self, workdir, cert):
+        self.workdir = workdir
+        self.cert = cert
+        self.metadata = pjoin(workdir, "metadata.xml")
+        self.fem = pysfemma.Femma(None)
+        self.fem.setup()
+        self.failed = 0
+
+    def run(self, sps):
+        """
+        Runs extract with -i over the given Service Providers
+
+        :return: What was printed, the powershell script or None
+        """
+        fp = open(self.metadata, "w")
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<md:EntitiesDescriptor %s Name="check">\n' % NAMESPACES)
+        for i in sps:
+            fp.write(SP % (i, KEY_DESCRIPTOR % ("", self.cert), i))
+        fp.write("</md:EntitiesDescriptor>\n")
+        fp.close()
+
+        if os.path.exists(self.fem.ps1_filename):
+            os.unlink(self.fem.ps1_filename)
+        self.fem.mds = pysfemma.MetadataStream([self.metadata])
+        log = pjoin(self.workdir, "run.log")
+        stdout = sys.stdout
+        sys.stdout = open(log, "w")
+        try:
+            self.fem.extract(True)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        printed = open(log).read()
+        if not os.path.exists(self.fem.ps1_filename):
+            return printed, None
+        return printed, open(self.fem.ps1_filename).read()
+
+    def deploy(self, failed=()):
+        """
+        What powershell_commit.tpl does, with the entityIDs of the trusts
+        the script failed for
+        """
+        state = self.fem.state
+        fp = open(state.pending_filename, "a")
+        for _eid in failed:
+            fp.write("%s\r\n" % _eid)
+        fp.close()
+        os.rename(state.pending_filename, state.deployed_filename)
+
+    def check(self, description, sps, full=False, added=(), updated=(),
+              removed=()):
+        printed, script = self.run(sps)
+        expected = sorted([eid(i) for i in added + updated + removed])
+        if script is None:
+            ok = not expected and not full
+            res = "no script"
+        else:
+            entities = sorted(ENTITY_RE.findall(script))
+            guarded = script.count("if (Get-ADFSRelyingPartyTrust -Name")
+            match = SUMMARY_RE.search(printed)
+            if full:
+                ok = (match is None and "Where-Object" in script and
+                      entities == expected)
+                res = "full script for %d" % len(entities)
+            else:
+                counts = (len(added), len(updated), len(removed))
+                ok = (match is not None and entities == expected and
+                      tuple(map(int, match.groups())) == counts)
+                res = match.group(0) if match else "no summary"
+            ok = ok and guarded == len(entities)
+            ok = ok and "Move-Item" in script.splitlines()[-1]
+        ok = ok and os.path.exists(self.fem.state.pending_filename) == (
+            script is not None)
+        print "%s %s: %s" % ("ok  " if ok else "FAIL", description, res)
+        if not ok:
+            self.failed += 1
+            print printed
+        return ok
+
+
+def main():
+    key = make_key(2048)
+    cert = base64.b64encode(crypto.dump_certificate(
+        crypto.FILETYPE_ASN1, make_cert(key, "sp.example.org", 1, -3600,
+                                        365 * 24 * 3600)))
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copytree(pjoin(ROOT, "templates"), pjoin(workdir, "templates"))
+        fp = open(pjoin(workdir, "settings.cfg"), "w")
+        fp.write(SETTINGS % "")
+        fp.close()
+        os.chdir(workdir)
+        checker = Checker(workdir, cert)
+
+        checker.check("first run", (1, 2, 3, 4), full=True,
+                      added=(1, 2, 3, 4))
+        checker.deploy(failed=[eid(2)])
+        checker.check("trust not added by the full script",
+                      (1, 2, 3, 4), updated=(2,))
+        checker.deploy()
+        checker.check("all deployed", (1, 2, 3, 4))
+
+        checker.check("changes", (1, 2, 5), added=(5,), removed=(3, 4))
+        # The script stopped half way, the marker stays where it is
+        checker.check("script not run through", (1, 2, 5), added=(5,),
+                      removed=(3, 4))
+        checker.deploy(failed=[eid(4), eid(5)])
+        checker.check("trusts not added or removed", (1, 2, 5),
+                      updated=(5,), removed=(4,))
+        checker.deploy()
+        checker.check("all deployed again", (1, 2, 5))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    if checker.failed:
+        print "%d checks failed" % checker.failed
+        sys.exit(1)
+    print "All checks passed"
+
+
+if __name__ == "__main__":
+    main()
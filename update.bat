@@ -6,6 +6,6 @@ set powershell=c:\windows\system32\windowspowershell\v1.0\powershell.exe
 set pshscript=.\update_adfs_rptrust.ps1
 
 cd %femmadir%
-%pythonbin% pysfemma.py -u %fedmetadata% -c %certificate%
+%pythonbin% pysfemma.py -u %fedmetadata% -c %certificate% -i
 %powershell% -ExecutionPolicy Unrestricted -File %pshscript%
-%pythonbin% pysfemma.py -c
+%pythonbin% pysfemma.py -C